@@ -0,0 +1,58 @@
+"""
+/commands benchmark: the cost of building the catalog embed on every call (walk the command
+tree, add a field per command) against picking the embed prebuilt at sync time. Both include
+the per-call footer.
+
+Usage: python bench_catalog.py [calls]   (default: 20000)
+"""
+import sys
+import tempfile
+import time
+
+import discord
+
+from harness import FakeMember, load_bot_module
+
+
+def rebuild_per_call(cb, user):
+    """What /commands did before the catalog: rebuild from the tree on every call."""
+    embed = discord.Embed(
+        title="🤖 Bot Commands",
+        description="Here are the available commands for this server:",
+        color=discord.Color.blue()
+    )
+    for cmd in cb.bot.tree.get_commands(guild=None):
+        embed.add_field(name=f"/{cmd.name}", value=cmd.description or "No description provided.", inline=False)
+    cb.add_footer(embed, user)
+    return embed
+
+
+def from_catalog(cb, user):
+    embed = cb.command_catalog.embed_for(user.guild_permissions)
+    cb.add_footer(embed, user)
+    return embed
+
+
+def main(calls):
+    with tempfile.TemporaryDirectory() as workdir:
+        cb = load_bot_module(workdir)
+        start = time.perf_counter()
+        cb.command_catalog.build(cb.bot.tree.get_commands(guild=None))
+        build = time.perf_counter() - start
+        print(f"{len(cb.bot.tree.get_commands())} commands; catalog built once in {build * 1000:.2f} ms\n")
+
+        member = FakeMember(1)
+        admin = FakeMember(2, permissions=discord.Permissions(manage_guild=True))
+        print(f"  {'approach':<18} {'user':<8} {'µs/call':>9}")
+        for name, render in (("rebuild per call", rebuild_per_call), ("prebuilt catalog", from_catalog)):
+            for label, user in (("member", member), ("admin", admin)):
+                render(cb, user)  # warm up
+                start = time.perf_counter()
+                for _ in range(calls):
+                    render(cb, user)
+                per_call = (time.perf_counter() - start) / calls
+                print(f"  {name:<18} {label:<8} {per_call * 1e6:9.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
@@ -0,0 +1,133 @@
+"""
+Per-command benchmark: drive the command handlers through the headless harness against a
+synthetic guild and report p50/p99 latency and memory per call. Latency includes the
+journal fsync each state-changing command waits for.
+
+Usage: python bench_commands.py [users ...]   (default: 1000 100000 1000000)
+"""
+import asyncio
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from harness import FakeInteraction, FakeMember, invoke, load_bot_module, press
+
+GUILD_ID = 10**17
+CURRENCIES = ("gold", "silver", "bronze")
+ITERATIONS = 300
+MEMORY_ITERATIONS = 50  # tracemalloc slows calls down, so memory is measured in a separate pass
+
+
+def populate(cb, users):
+    """Fill the database with one guild of `users` members holding every currency."""
+    conn = cb.db.connect()
+    cb.create_tables(conn)
+    rng = random.Random(0)
+    with conn:
+        conn.executemany("INSERT INTO currencies VALUES (?, ?, ?)", [(GUILD_ID, name, "💰") for name in CURRENCIES])
+        conn.executemany("INSERT INTO jackpots VALUES (?, ?, 0)", [(GUILD_ID, name) for name in CURRENCIES])
+        conn.execute("INSERT INTO guild_settings VALUES (?, 0, 0, 0)", (GUILD_ID,))  # no cooldowns
+        for name in CURRENCIES:
+            conn.executemany("INSERT INTO balances VALUES (?, ?, ?, ?)",
+                             ((GUILD_ID, user_id, name, rng.randint(100, 10000)) for user_id in range(1, users + 1)))
+        cb.bump_generation(conn)
+
+
+def scenarios(cb):
+    """{ name: (prepare(user, other), run(user, other)) } for every benchmarked command."""
+    def new(user):
+        return FakeInteraction(GUILD_ID, user)
+
+    def nothing(user, other):
+        pass
+
+    def stock_item(user, other):
+        cb.set_inventory_qty(GUILD_ID, user.id, "energy_drink", 1)
+
+    async def trade(user, other):
+        proposal = await invoke(cb.trade, new(user), other, "gold", 1, "silver", 1)
+        await press(proposal.view().confirm, new(user))
+        await press(proposal.view().confirm, new(other))
+
+    return {
+        "balance": (nothing, lambda user, other: invoke(cb.balance, new(user), None)),
+        "leaderboard": (nothing, lambda user, other: invoke(cb.leaderboard, new(user))),
+        "rank": (nothing, lambda user, other: invoke(cb.rank, new(user), "gold", None)),
+        "homework": (nothing, lambda user, other: invoke(cb.homework, new(user))),
+        "give": (nothing, lambda user, other: invoke(cb.give, new(user), "gold", other, 1)),
+        "gamble": (nothing, lambda user, other: invoke(cb.gamble, new(user), "silver", 1)),
+        "rob": (nothing, lambda user, other: invoke(cb.rob, new(user), other, None)),
+        "rob_random": (nothing, lambda user, other: invoke(cb.rob, new(user), None, "bronze")),
+        "trade": (nothing, trade),
+        "buy": (nothing, lambda user, other: invoke(cb.buy, new(user), "energy_drink", "bronze")),
+        "use": (stock_item, lambda user, other: invoke(cb.use, new(user), "energy_drink")),
+        "inventory": (stock_item, lambda user, other: invoke(cb.inventory, new(user))),
+    }
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+async def bench_command(prepare, run, pick):
+    await run(*pick())  # warm up: lazy guild load, rank and weight indexes
+
+    latencies = []
+    for _ in range(ITERATIONS):
+        user, other = pick()
+        prepare(user, other)
+        start = time.perf_counter()
+        await run(user, other)
+        latencies.append(time.perf_counter() - start)
+
+    peaks = []
+    blocks = []
+    tracemalloc.start()
+    for _ in range(MEMORY_ITERATIONS):
+        user, other = pick()
+        prepare(user, other)
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        blocks_before = sys.getallocatedblocks()
+        await run(user, other)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+        blocks.append(sys.getallocatedblocks() - blocks_before)
+    tracemalloc.stop()
+    return latencies, peaks, blocks
+
+
+def bench(users):
+    with tempfile.TemporaryDirectory() as workdir:
+        cb = load_bot_module(workdir)
+        start = time.perf_counter()
+        populate(cb, users)
+        cb.load_db()
+        cb.db_writer.start()
+        print(f"\n{users:,} users, {len(CURRENCIES)} currencies (setup {time.perf_counter() - start:.1f} s)")
+        print(f"  {'command':<12} {'p50 ms':>9} {'p99 ms':>9} {'peak KiB':>9} {'net blocks':>11}")
+
+        rng = random.Random(1)
+
+        def pick():
+            user_id, other_id = rng.sample(range(1, users + 1), 2)
+            return FakeMember(user_id), FakeMember(other_id)
+
+        async def run_all():
+            for name, (prepare, run) in scenarios(cb).items():
+                latencies, peaks, blocks = await bench_command(prepare, run, pick)
+                print(f"  {name:<12} {percentile(latencies, 0.5) * 1000:9.3f} {percentile(latencies, 0.99) * 1000:9.3f} "
+                      f"{percentile(peaks, 0.5) / 1024:9.1f} {percentile(blocks, 0.5):11,}")
+
+        try:
+            asyncio.run(run_all())
+        finally:
+            cb.shutdown_db()
+
+
+if __name__ == "__main__":
+    for users in [int(arg) for arg in sys.argv[1:]] or [1_000, 100_000, 1_000_000]:
+        bench(users)
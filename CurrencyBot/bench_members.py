@@ -0,0 +1,106 @@
+"""
+Member cache benchmark: resident memory of one large guild with discord.py caching every
+member (what intents.members does by default), against CACHE_ALL_MEMBERS = False, where no
+Member objects are kept and leaderboard names live in the bounded DisplayNameCache.
+
+Each mode runs in a fresh interpreter. Members are built from gateway-shaped payloads through
+a real ConnectionState, the same way discord.py processes a member chunk, so the numbers
+include the User objects, role lists and avatars that come with them. The bounded mode fills
+the name cache to capacity, its worst case.
+
+Usage: python bench_members.py [members ...]   (default: 50000)
+"""
+import gc
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+GUILD_ID = 10**17
+CHUNK_SIZE = 1000  # members per GUILD_MEMBERS_CHUNK event, as Discord sends them
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * 4096
+
+
+def member_payload(user_id):
+    return {
+        "user": {"id": str(user_id), "username": f"member{user_id}", "global_name": f"Member {user_id}",
+                 "discriminator": "0", "avatar": f"{user_id:032x}", "public_flags": 0},
+        "nick": None,
+        "roles": [str(GUILD_ID + 1), str(GUILD_ID + 2)],
+        "joined_at": "2024-01-01T00:00:00.000000+00:00",
+        "deaf": False,
+        "mute": False,
+        "flags": 0,
+    }
+
+
+def make_guild(discord, cache_members):
+    from discord.state import ConnectionState
+
+    intents = discord.Intents.default()
+    intents.members = True
+    flags = discord.MemberCacheFlags.from_intents(intents) if cache_members else discord.MemberCacheFlags.none()
+    state = ConnectionState(dispatch=lambda *args: None, handlers={}, hooks={}, http=None,
+                            intents=intents, member_cache_flags=flags, chunk_guilds_at_startup=cache_members)
+    guild = discord.Guild(data={"id": str(GUILD_ID), "name": "bench", "roles": [], "member_count": 0}, state=state)
+    return state, guild
+
+
+def run_mode(mode, members):
+    with tempfile.TemporaryDirectory() as workdir:
+        from harness import load_bot_module
+        cb = load_bot_module(workdir)
+        import discord
+
+        cache_members = mode == "cached"
+        state, guild = make_guild(discord, cache_members)
+        gc.collect()
+        rss_before = rss_bytes()
+        tracemalloc.start()
+        start = time.perf_counter()
+
+        for first in range(1, members + 1, CHUNK_SIZE):
+            chunk = [discord.Member(data=member_payload(user_id), guild=guild, state=state)
+                     for user_id in range(first, min(first + CHUNK_SIZE, members + 1))]
+            if cache_members:
+                for member in chunk:
+                    guild._add_member(member)
+            else:
+                # Only names that leaderboards asked for are kept, up to the cache's capacity
+                for member in chunk:
+                    if member.id <= cb.DISPLAY_NAME_CACHE_SIZE:
+                        cb.display_names.remember(GUILD_ID, member.id, member.display_name)
+            del chunk
+
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        traced, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss_after = rss_bytes()
+        cached = len(guild._members) if cache_members else len(cb.display_names.names)
+        print(f"{mode}\t{cached}\t{traced}\t{rss_after - rss_before}\t{elapsed}")
+
+
+def bench(members):
+    print(f"\n{members:,} members in one guild")
+    print(f"  {'mode':<8} {'entries':>9} {'traced MiB':>11} {'RSS MiB':>9} {'B/member':>9} {'fill s':>7}")
+    for mode in ("cached", "bounded"):
+        out = subprocess.run([sys.executable, __file__, "--mode", mode, str(members)],
+                             capture_output=True, text=True, check=True).stdout
+        _, cached, traced, rss, elapsed = out.strip().splitlines()[-1].split("\t")
+        traced, rss = int(traced), int(rss)
+        print(f"  {mode:<8} {int(cached):>9,} {traced / 2**20:>11.1f} {rss / 2**20:>9.1f} "
+              f"{traced / members:>9.0f} {float(elapsed):>7.2f}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--mode"]:
+        run_mode(sys.argv[2], int(sys.argv[3]))
+    else:
+        for members in [int(arg) for arg in sys.argv[1:]] or [50_000]:
+            bench(members)
@@ -0,0 +1,78 @@
+"""
+Startup benchmark: time loading every guild from SQLite vs. from the binary snapshot.
+
+Usage: python bench_startup.py [rows ...]   (default: 10000 100000 1000000 balance rows)
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from harness import load_bot_module
+
+CURRENCIES_PER_GUILD = 5
+USERS_PER_GUILD = 2000  # 10k balance rows per guild
+
+
+def populate(cb, rows):
+    """Fill the database with `rows` balance rows plus matching cooldowns and guild settings."""
+    conn = cb.db.connect()
+    cb.create_tables(conn)
+    guilds = max(1, rows // (CURRENCIES_PER_GUILD * USERS_PER_GUILD))
+    rng = random.Random(0)
+    with conn:
+        for g in range(guilds):
+            guild_id = 10**17 + g
+            names = [f"coin{c}" for c in range(CURRENCIES_PER_GUILD)]
+            conn.executemany("INSERT INTO currencies VALUES (?, ?, ?)", [(guild_id, n, "💰") for n in names])
+            conn.execute("INSERT INTO guild_settings VALUES (?, 21600, 21600, 21600)", (guild_id,))
+            users = [10**17 + g * USERS_PER_GUILD + u for u in range(USERS_PER_GUILD)]
+            conn.executemany("INSERT INTO balances VALUES (?, ?, ?, ?)",
+                             [(guild_id, u, n, rng.randint(0, 10000)) for n in names for u in users])
+            conn.executemany("INSERT INTO cooldowns VALUES (?, ?, 'homework', ?)",
+                             [(guild_id, u, time.time()) for u in users])
+            conn.executemany("INSERT INTO jackpots VALUES (?, ?, ?)", [(guild_id, n, 0) for n in names])
+        cb.bump_generation(conn)
+    return [10**17 + g for g in range(guilds)]
+
+
+def reset(cb):
+    for state_map in cb.GUILD_STATE_MAPS:
+        dict.clear(state_map)
+
+
+def bench(rows):
+    with tempfile.TemporaryDirectory() as workdir:
+        cb = load_bot_module(workdir)
+        guild_ids = populate(cb, rows)
+        conn = cb.db.connect()
+
+        start = time.perf_counter()
+        for guild_id in guild_ids:
+            cb.install_guild_state(guild_id, cb.read_guild_state(conn, guild_id))
+        sqlite_time = time.perf_counter() - start
+        reset(cb)
+
+        start = time.perf_counter()
+        cb.write_snapshot(conn)
+        write_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        assert cb.snapshot.open(cb.db_generation(conn))
+        for guild_id in guild_ids:
+            cb.install_guild_state(guild_id, cb.snapshot.read_guild(guild_id))
+        snapshot_time = time.perf_counter() - start
+
+        size = os.path.getsize(cb.SNAPSHOT_PATH)
+        cb.snapshot.close()
+        cb.db.close()
+
+    print(f"{rows:>9,} rows  sqlite {sqlite_time * 1000:9.1f} ms  snapshot {snapshot_time * 1000:9.1f} ms  "
+          f"({sqlite_time / snapshot_time:4.1f}x)  snapshot write {write_time * 1000:9.1f} ms  "
+          f"size {size / 1e6:7.2f} MB")
+
+
+if __name__ == "__main__":
+    for rows in [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000]:
+        bench(rows)
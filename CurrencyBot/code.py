@@ -1,36 +1,591 @@
 import discord
 import ssl
 import aiohttp
+from aiohttp import web
 import certifi
 from discord import app_commands, Permissions
 from discord.ext import commands
 import sqlite3
 import time
+import random
+import queue
+import threading
+import atexit
+import asyncio
+import signal
+import os
+import json
+import struct
+import zlib
+import marshal
+import mmap
+import sys
+import bisect
+import heapq
+import weakref
+import contextlib
+import itertools
+import re
+import traceback
+from array import array
+from functools import lru_cache
+from collections import OrderedDict
 from datetime import timedelta
 from datetime import datetime
 from discord.ui import View, Button
 
 
 # --- In-Memory Data Structure ---
-# Format: { guild_id: { currency_name: { user_id: amount, ... }, ... }, ... }
-currencies_data = {}
-# Format: { guild_id: { "homework": seconds, "officehours": seconds } }
-guild_cooldowns = {}
+# Guild state is loaded lazily: the first lookup of a guild_id in any of these maps
+# pulls that guild's rows from SQLite, and cold guilds are evicted again (see below).
+
+class GuildStateMap(dict):
+    """A { guild_id: ... } dict that loads a guild's state on first access."""
+
+    def __getitem__(self, guild_id):
+        ensure_guild_loaded(guild_id)
+        return dict.__getitem__(self, guild_id)
+
+    def get(self, guild_id, default=None):
+        ensure_guild_loaded(guild_id)
+        return dict.get(self, guild_id, default)
+
+    def __contains__(self, guild_id):
+        ensure_guild_loaded(guild_id)
+        return dict.__contains__(self, guild_id)
+
+    def setdefault(self, guild_id, default=None):
+        ensure_guild_loaded(guild_id)
+        return dict.setdefault(self, guild_id, default)
+
+
+def pack_rank_key(amount, user_id):
+    """Pack a balance into one int that sorts by amount descending, then user id ascending."""
+    return (-amount << 64) | user_id
+
+
+def unpack_rank_key(key):
+    """Return (user_id, amount) for a packed rank key."""
+    return key & 0xFFFFFFFFFFFFFFFF, -(key >> 64)
+
+
+class RankIndex:
+    """
+    Order-statistic index of packed rank keys: sorted buckets of at most 2 * LOAD keys,
+    plus a Fenwick tree over bucket sizes so rank and offset lookups are O(log n).
+    """
+    LOAD = 512
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self.buckets = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.size = len(keys)
+        self.rebuild_tree()
+
+    def rebuild_tree(self):
+        tree = [0] + [len(bucket) for bucket in self.buckets]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def tree_add(self, b, delta):
+        i = b + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def count_before(self, b):
+        """Number of keys in buckets[:b]."""
+        total = 0
+        while b > 0:
+            total += self.tree[b]
+            b -= b & -b
+        return total
+
+    def __len__(self):
+        return self.size
+
+    def add(self, key):
+        self.size += 1
+        if not self.buckets:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            self.rebuild_tree()
+            return
+        b = min(bisect.bisect_left(self.maxes, key), len(self.buckets) - 1)
+        bucket = self.buckets[b]
+        bisect.insort(bucket, key)
+        self.maxes[b] = bucket[-1]
+        if len(bucket) > 2 * self.LOAD:
+            self.buckets.insert(b + 1, bucket[self.LOAD:])
+            del bucket[self.LOAD:]
+            self.maxes[b] = bucket[-1]
+            self.maxes.insert(b + 1, self.buckets[b + 1][-1])
+            self.rebuild_tree()
+        else:
+            self.tree_add(b, 1)
+
+    def remove(self, key):
+        b = bisect.bisect_left(self.maxes, key)
+        bucket = self.buckets[b]
+        del bucket[bisect.bisect_left(bucket, key)]
+        self.size -= 1
+        if bucket:
+            self.maxes[b] = bucket[-1]
+            self.tree_add(b, -1)
+        else:
+            del self.buckets[b]
+            del self.maxes[b]
+            self.rebuild_tree()
+
+    def rank(self, key):
+        """0-based position of key (or of where it would go)."""
+        b = bisect.bisect_left(self.maxes, key)
+        if b == len(self.buckets):
+            return self.size
+        return self.count_before(b) + bisect.bisect_left(self.buckets[b], key)
+
+    def slice(self, start, stop):
+        """Keys at positions [start, stop), found by descending the Fenwick tree."""
+        start, stop = max(start, 0), min(stop, self.size)
+        if start >= stop:
+            return []
+        # Find the bucket containing position `start`
+        b, remaining = 0, start
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            nxt = b + step
+            if nxt < len(self.tree) and self.tree[nxt] <= remaining:
+                b = nxt
+                remaining -= self.tree[nxt]
+            step >>= 1
+        keys = []
+        i = remaining
+        while len(keys) < stop - start:
+            bucket = self.buckets[b]
+            keys.extend(bucket[i:i + stop - start - len(keys)])
+            b, i = b + 1, 0
+        return keys
+
+
+class WeightTree:
+    """
+    Fenwick tree over per-slot weights: prefix sums, point updates, appends and weighted
+    sampling are all O(log n).
+    """
+    __slots__ = ("tree",)
+
+    def __init__(self, weights=()):
+        tree = array("q", [0])
+        tree.extend(weights)
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def prefix(self, n):
+        """Sum of the weights of slots 0 .. n - 1."""
+        total = 0
+        while n > 0:
+            total += self.tree[n]
+            n -= n & -n
+        return total
+
+    def total(self):
+        return self.prefix(len(self))
+
+    def add(self, slot, delta):
+        i = slot + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def append(self, weight):
+        i = len(self.tree)
+        self.tree.append(weight + self.prefix(i - 1) - self.prefix(i - (i & -i)))
+
+    def find(self, r):
+        """The slot whose cumulative weight range contains r, for 0 <= r < total()."""
+        pos = 0
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(self.tree) and self.tree[nxt] <= r:
+                pos = nxt
+                r -= self.tree[nxt]
+            step >>= 1
+        return pos
+
+
+class BalanceStore:
+    """
+    user_id -> amount for one currency, kept entirely in int64 arrays instead of a dict of
+    Python ints. Each user gets a dense, stable slot on first write; a sorted id index
+    (binary searched) maps user ids to slots.
+    """
+    __slots__ = ("ids", "id_slots", "users", "amounts", "rank_index", "weight_tree")
+
+    def __init__(self, balances=None):
+        self.ids = array("q")  # sorted user ids
+        self.id_slots = array("q")  # slot of ids[i]
+        self.users = array("q")  # slot -> user_id
+        self.amounts = array("q")  # slot -> amount
+        self.rank_index = None  # RankIndex over positive balances, built on first use
+        self.weight_tree = None  # WeightTree of positive balances by slot, built on first use
+        for user_id, amount in sorted((balances or {}).items()):
+            self.id_slots.append(len(self.users))
+            self.ids.append(user_id)
+            self.users.append(user_id)
+            self.amounts.append(amount)
+
+    def slot(self, user_id):
+        """Return the user's slot, or -1 if they have never held this currency."""
+        i = bisect.bisect_left(self.ids, user_id)
+        if i < len(self.ids) and self.ids[i] == user_id:
+            return self.id_slots[i]
+        return -1
+
+    def __getitem__(self, user_id):
+        slot = self.slot(user_id)
+        if slot < 0:
+            raise KeyError(user_id)
+        return self.amounts[slot]
+
+    def __setitem__(self, user_id, amount):
+        i = bisect.bisect_left(self.ids, user_id)
+        found = i < len(self.ids) and self.ids[i] == user_id
+        old = self.amounts[self.id_slots[i]] if found else 0
+        if self.rank_index is not None:
+            if old > 0:
+                self.rank_index.remove(pack_rank_key(old, user_id))
+            if amount > 0:
+                self.rank_index.add(pack_rank_key(amount, user_id))
+        if found:
+            if self.weight_tree is not None:
+                self.weight_tree.add(self.id_slots[i], max(amount, 0) - max(old, 0))
+            self.amounts[self.id_slots[i]] = amount
+            return
+        if self.weight_tree is not None:
+            self.weight_tree.append(max(amount, 0))
+        self.ids.insert(i, user_id)
+        self.id_slots.insert(i, len(self.users))
+        self.users.append(user_id)
+        self.amounts.append(amount)
+
+    def get(self, user_id, default=None):
+        slot = self.slot(user_id)
+        return default if slot < 0 else self.amounts[slot]
+
+    def setdefault(self, user_id, default=0):
+        if user_id not in self:
+            self[user_id] = default
+        return self[user_id]
+
+    def __contains__(self, user_id):
+        return self.slot(user_id) >= 0
+
+    def __len__(self):
+        return len(self.users)
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def keys(self):
+        return iter(self.users)
+
+    def values(self):
+        return iter(self.amounts)
+
+    def items(self):
+        return zip(self.users, self.amounts)
+
+    def total(self):
+        return sum(self.amounts)
+
+    def nonzero_count(self):
+        return len(self.amounts) - self.amounts.count(0)
+
+    def ranking(self):
+        """The RankIndex over positive balances, built from the arrays on first use."""
+        if self.rank_index is None:
+            self.rank_index = RankIndex(pack_rank_key(amount, user_id)
+                                        for user_id, amount in self.items() if amount > 0)
+        return self.rank_index
+
+    def holders(self):
+        """Number of users with a positive balance."""
+        return len(self.ranking())
+
+    def page(self, offset, count):
+        """[(user_id, amount), ...] for ranks offset .. offset + count - 1, highest balance first."""
+        return [unpack_rank_key(key) for key in self.ranking().slice(offset, offset + count)]
+
+    def top(self, n):
+        """The n largest positive balances as [(user_id, amount), ...], highest first."""
+        return self.page(0, n)
+
+    def rank(self, user_id):
+        """0-based rank of the user among positive balances, or None if they hold none."""
+        amount = self.get(user_id, 0)
+        if amount <= 0:
+            return None
+        return self.ranking().rank(pack_rank_key(amount, user_id))
+
+    def weights(self):
+        """The WeightTree over positive balances, built from the arrays on first use."""
+        if self.weight_tree is None:
+            self.weight_tree = WeightTree(max(amount, 0) for amount in self.amounts)
+        return self.weight_tree
+
+    def sample_holder(self, exclude=()):
+        """
+        Pick a user with probability proportional to their positive balance, never choosing
+        anyone in `exclude`; returns None if nobody else holds any. O(k log n) for k excluded.
+        """
+        weights = self.weights()
+        skipped = []  # (slot, weight) of excluded holders, in slot order
+        for user_id in set(exclude):
+            slot = self.slot(user_id)
+            if slot >= 0 and self.amounts[slot] > 0:
+                skipped.append((slot, self.amounts[slot]))
+        skipped.sort()
+        total = weights.total() - sum(weight for _, weight in skipped)
+        if total <= 0:
+            return None
+        # Draw from the weight line with the excluded slots' ranges cut out, then map it back
+        r = random.randrange(total)
+        for slot, weight in skipped:
+            if r < weights.prefix(slot):
+                break
+            r += weight
+        return self.users[weights.find(r)]
+
+    def memory_usage(self):
+        """Bytes held by the arrays, including their spare capacity, plus the rank and weight indexes if built."""
+        usage = sum(sys.getsizeof(a) for a in (self.ids, self.id_slots, self.users, self.amounts))
+        if self.weight_tree is not None:
+            usage += sys.getsizeof(self.weight_tree.tree)
+        if self.rank_index is not None:
+            int_size = sys.getsizeof(2**100)
+            usage += sum(sys.getsizeof(bucket) + int_size * len(bucket) for bucket in self.rank_index.buckets)
+        return usage
+
+
+def search_key(text):
+    """How names and typed queries are compared: case-insensitive, "_" matching a space."""
+    return text.lower().replace("_", " ")
+
+
+class NameIndex:
+    """
+    Autocomplete index over a set of names: search keys kept sorted for prefix matches, and
+    postings for every substring of up to GRAM characters for substring matches, so a query
+    only touches the names that match it. Results rank prefix matches first, each group
+    recently used first, then alphabetically.
+    """
+    GRAM = 3
+    RECENT = 25  # recently used names remembered for ranking
+
+    def __init__(self, names=()):
+        self.keys = []  # sorted [(search key, name), ...]
+        self.key_of = {}  # name -> search key
+        self.grams = {}  # substring -> { name, ... }
+        self.recent = OrderedDict()  # names, least to most recently used
+        for name in names:
+            self.add(name)
+
+    def grams_of(self, key):
+        return {key[i:i + n] for n in range(1, self.GRAM + 1) for i in range(len(key) - n + 1)}
+
+    def add(self, name):
+        key = self.key_of[name] = search_key(name)
+        bisect.insort(self.keys, (key, name))
+        for gram in self.grams_of(key):
+            self.grams.setdefault(gram, set()).add(name)
+
+    def remove(self, name):
+        key = self.key_of.pop(name)
+        del self.keys[bisect.bisect_left(self.keys, (key, name))]
+        for gram in self.grams_of(key):
+            self.grams[gram].discard(name)
+            if not self.grams[gram]:
+                del self.grams[gram]
+        return self.recent.pop(name, False)
+
+    def rename(self, old_name, new_name):
+        was_recent = self.remove(old_name) is not False
+        self.add(new_name)
+        if was_recent:
+            self.touch(new_name)
+
+    def touch(self, name):
+        recent = self.recent
+        if name in recent:
+            recent.move_to_end(name)
+        else:
+            recent[name] = None
+            if len(recent) > self.RECENT:
+                recent.popitem(last=False)
+
+    def search(self, query, limit=25):
+        query = search_key(query)
+        keys, key_of = self.keys, self.key_of
+        # Prefix matches are a contiguous run of the sorted keys, already alphabetical
+        results = [name for name in reversed(self.recent) if key_of[name].startswith(query)][:limit]
+        shown = set(results)
+        start = bisect.bisect_left(keys, (query,))
+        end = bisect.bisect_left(keys, (query + "\U0010ffff",))
+        rest = (keys[i][1] for i in range(start, end))
+        results += itertools.islice((name for name in rest if name not in shown), limit - len(results))
+        if len(results) == limit or not query:
+            return results
+
+        # Every prefix match is in results by now
+        prefixed = set(results)
+
+        if len(query) <= self.GRAM:
+            contained = self.grams.get(query, set()) - prefixed
+        else:
+            # Every GRAM-long piece of the query must occur; confirm the whole query on the survivors
+            postings = sorted((self.grams.get(query[i:i + self.GRAM], set())
+                               for i in range(len(query) - self.GRAM + 1)), key=len)
+            contained = {name for name in set.intersection(*postings)
+                         if name not in prefixed and query in self.key_of[name]}
+        limit -= len(results)
+        recent = [name for name in reversed(self.recent) if name in contained][:limit]
+        shown = set(recent)
+        rest = heapq.nsmallest(limit, contained, key=key_of.__getitem__)
+        return results + recent + [name for name in rest if name not in shown][:limit - len(recent)]
+
+
+# Format: { guild_id: { currency_name: { "emoji": str, "balances": BalanceStore }, ... }, ... }
+currencies_data = GuildStateMap()
+# Format: { guild_id: { "homework": seconds, "officehours": seconds, "rob": seconds } }
+guild_cooldowns = GuildStateMap()
+# Format: { guild_id: { user_id: { command: last_used, ... } } }, managed by cooldown_engine
+cooldowns = GuildStateMap()
+# Format: { guild_id: { currency_name: amount } }
+jackpots = GuildStateMap()
+# Format: { guild_id: { user_id: { item: quantity } } }
+inventories = GuildStateMap()
+# Format: { guild_id: { user_id: { buff_name, ... } } }
+active_buffs = GuildStateMap()
+
+GUILD_STATE_MAPS = (currencies_data, guild_cooldowns, cooldowns, jackpots, inventories, active_buffs)
+GUILD_STATE_KEYS = ("currencies", "guild_cooldowns", "cooldowns", "jackpots", "inventories", "active_buffs")
+
+# Reverse index of nonzero balances, derived from currencies_data when a guild loads and
+# kept current by the balance mutators; never persisted.
+# Format: { guild_id: { user_id: { currency_name, ... } } }
+holdings = GuildStateMap()
+# Autocomplete index of each loaded guild's currency names, derived the same way.
+# Format: { guild_id: NameIndex }
+currency_index = GuildStateMap()
 
 
 DB_PATH = "currencies.db"
+JOURNAL_PATH = "currencies.journal"
+SNAPSHOT_PATH = "currencies.snapshot"
 
 COOLDOWN_SECONDS = 6 * 60 * 60  # 6 hours
+COOLDOWN_COMMANDS = ("homework", "officehours", "rob")
+
+
+# --- Database Connection ---
+# One connection for the whole process, shared by load_db() and the writer thread.
+
+DB_CACHE_KIB = 16 * 1024  # page cache size
+DB_STATEMENT_CACHE = 256
+WAL_CHECKPOINT_INTERVAL = 60  # seconds between forced WAL checkpoints
+
+
+class Database:
+    def __init__(self):
+        self.conn = None
+        self.lock = threading.RLock()
+        self.last_checkpoint = time.monotonic()
+
+    def connect(self):
+        """Return the shared connection, opening and tuning it on first use."""
+        with self.lock:
+            if self.conn is None:
+                conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KIB}")
+                conn.execute("PRAGMA temp_store=MEMORY")
+                self.conn = conn
+            return self.conn
+
+    def checkpoint(self, force=False):
+        """
+        Fold the -wal file back into the database so it doesn't grow without bound.
+        Returns True once everything committed so far is synced to the main database file.
+        """
+        if not force and time.monotonic() - self.last_checkpoint < WAL_CHECKPOINT_INTERVAL:
+            return False
+        with self.lock:
+            if self.conn is None:
+                return False
+            busy, _, _ = self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        self.last_checkpoint = time.monotonic()
+        return busy == 0
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.checkpoint(force=True)
+                self.conn.close()
+                self.conn = None
+
+
+db = Database()
 
 
 # --- Database Helpers ---
 
 def load_db():
-    """Load database into in-memory dictionary."""
-    global currencies_data, hw_cooldowns, office_cooldowns, rob_cooldowns, jackpots, inventories, active_buffs
-    conn = sqlite3.connect(DB_PATH)
+    """Prepare the database; guild state itself is loaded on demand by ensure_guild_loaded()."""
+    started = time.perf_counter()
+    with db.lock:
+        conn = db.connect()
+        create_tables(conn)
+
+        # --- Replay changes acknowledged after the last SQLite commit ---
+        replay_journal(conn)
+        ledger.seed(conn)
+
+        snapshot.open(db_generation(conn))
+
+    for state_map in GUILD_STATE_MAPS:
+        dict.clear(state_map)
+    dict.clear(holdings)
+    dict.clear(currency_index)
+    render_cache.clear()
+    loaded_guilds.clear()
+    evicted_at.clear()
+    metrics.observe("currencybot_load_db_seconds", time.perf_counter() - started)
+
+
+def create_tables(conn):
     c = conn.cursor()
 
+    # Bumped by every write so a snapshot can tell whether it still matches the database
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    """)
+    c.execute("INSERT OR IGNORE INTO meta VALUES ('generation', 0)")
+
     # Create tables if not exist
     c.execute("""
         CREATE TABLE IF NOT EXISTS currencies (
@@ -62,9 +617,13 @@ def load_db():
         CREATE TABLE IF NOT EXISTS guild_settings (
             guild_id INTEGER PRIMARY KEY,
             homework_cooldown INTEGER DEFAULT 21600,
-            officehours_cooldown INTEGER DEFAULT 21600
+            officehours_cooldown INTEGER DEFAULT 21600,
+            rob_cooldown INTEGER DEFAULT 21600
         )
     """)
+    # Older databases predate the rob cooldown column
+    if "rob_cooldown" not in [row[1] for row in c.execute("PRAGMA table_info(guild_settings)")]:
+        c.execute("ALTER TABLE guild_settings ADD COLUMN rob_cooldown INTEGER DEFAULT 21600")
     c.execute("""
         CREATE TABLE IF NOT EXISTS jackpots (
             guild_id INTEGER,
@@ -74,6 +633,23 @@ def load_db():
         )
     """)
 
+    # --- Ledger: append-only history of every transfer ---
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER,
+            from_user INTEGER,
+            to_user INTEGER,
+            currency TEXT,
+            amount INTEGER,
+            reason TEXT,
+            ts REAL
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS ledger_from ON ledger (guild_id, from_user, ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS ledger_to ON ledger (guild_id, to_user, ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS ledger_currency ON ledger (guild_id, currency, ts)")
+
     # --- Inventories ---
     c.execute("""
         CREATE TABLE IF NOT EXISTS inventories (
@@ -93,165 +669,1768 @@ def load_db():
             PRIMARY KEY (guild_id, user_id, buff_name)
         )
     """)
+    conn.commit()
+
+
+def read_guild_state(conn, guild_id):
+    """
+    Read one guild's rows from SQLite into plain nested dicts, keyed like GUILD_STATE_KEYS.
+    Balances stay plain dicts here so the state can be marshalled into a snapshot.
+    """
+    c = conn.cursor()
+    state = {key: {} for key in GUILD_STATE_KEYS}
 
     # --- Load jackpots ---
-    jackpots = {}
-    c.execute("SELECT guild_id, currency, amount FROM jackpots")
-    for guild_id, currency, amount in c.fetchall():
-        jackpots.setdefault(guild_id, {})[currency] = amount
+    c.execute("SELECT currency, amount FROM jackpots WHERE guild_id=?", (guild_id,))
+    for currency, amount in c.fetchall():
+        state["jackpots"][currency] = amount
 
     # --- Load currencies ---
-    currencies_data.clear()
-    c.execute("SELECT guild_id, name, emoji FROM currencies")
-    for guild_id, name, emoji in c.fetchall():
-        currencies_data.setdefault(guild_id, {})[name] = {"emoji": emoji, "balances": {}}
+    guild_currencies = state["currencies"]
+    c.execute("SELECT name, emoji FROM currencies WHERE guild_id=?", (guild_id,))
+    for name, emoji in c.fetchall():
+        guild_currencies[name] = {"emoji": emoji, "balances": {}}
 
     # --- Load balances ---
-    c.execute("SELECT guild_id, user_id, currency, amount FROM balances")
-    for guild_id, user_id, currency, amount in c.fetchall():
-        if guild_id in currencies_data and currency in currencies_data[guild_id]:
-            currencies_data[guild_id][currency]["balances"][user_id] = amount
+    c.execute("SELECT user_id, currency, amount FROM balances WHERE guild_id=?", (guild_id,))
+    for user_id, currency, amount in c.fetchall():
+        if currency in guild_currencies:
+            guild_currencies[currency]["balances"][user_id] = amount
 
     # --- Load cooldowns ---
-    hw_cooldowns = {}
-    office_cooldowns = {}
-    rob_cooldowns = {}
-    inventories = {}
-    active_buffs = {}
-
-
-    c.execute("SELECT guild_id, user_id, command, last_used FROM cooldowns")
-    for guild_id, user_id, command, last_used in c.fetchall():
-        if command == "homework":
-            hw_cooldowns.setdefault(guild_id, {})[user_id] = last_used
-        elif command == "officehours":
-            office_cooldowns.setdefault(guild_id, {})[user_id] = last_used
-        elif command == "rob":
-            rob_cooldowns.setdefault(guild_id, {})[user_id] = last_used
+    c.execute("SELECT user_id, command, last_used FROM cooldowns WHERE guild_id=?", (guild_id,))
+    for user_id, command, last_used in c.fetchall():
+        if command in COOLDOWN_COMMANDS:
+            state["cooldowns"].setdefault(user_id, {})[command] = last_used
 
     # --- Load guild settings ---
-    c.execute("SELECT guild_id, homework_cooldown, officehours_cooldown, rob_cooldown FROM guild_settings")
-    for guild_id, hw_cd, office_cd, rob_cd in c.fetchall():
-        guild_cooldowns[guild_id] = {
+    c.execute("SELECT homework_cooldown, officehours_cooldown, rob_cooldown FROM guild_settings WHERE guild_id=?",
+              (guild_id,))
+    for hw_cd, office_cd, rob_cd in c.fetchall():
+        state["guild_cooldowns"] = {
             "homework": hw_cd,
             "officehours": office_cd,
             "rob": rob_cd if rob_cd is not None else 6 * 60 * 60  # default 6 hours
         }
 
-    inventories.clear()
-    c.execute("SELECT guild_id, user_id, item, quantity FROM inventories")
-    for guild_id, user_id, item, quantity in c.fetchall():
-        inventories.setdefault(guild_id, {}).setdefault(user_id, {})[item] = quantity
+    c.execute("SELECT user_id, item, quantity FROM inventories WHERE guild_id=?", (guild_id,))
+    for user_id, item, quantity in c.fetchall():
+        state["inventories"].setdefault(user_id, {})[item] = quantity
 
     # --- Load Active Buffs ---
-    active_buffs.clear()
-    c.execute("SELECT guild_id, user_id, buff_name FROM active_buffs")
-    for guild_id, user_id, buff_name in c.fetchall():
-        active_buffs.setdefault(guild_id, {}).setdefault(user_id, set()).add(buff_name)
+    c.execute("SELECT user_id, buff_name FROM active_buffs WHERE guild_id=?", (guild_id,))
+    for user_id, buff_name in c.fetchall():
+        state["active_buffs"].setdefault(user_id, set()).add(buff_name)
+
+    return state
+
+
+def install_guild_state(guild_id, state):
+    """Place a guild's state, as returned by read_guild_state(), into the in-memory maps."""
+    for data in state["currencies"].values():
+        data["balances"] = BalanceStore(data["balances"])
+    for key, state_map in zip(GUILD_STATE_KEYS, GUILD_STATE_MAPS):
+        if state[key]:
+            dict.__setitem__(state_map, guild_id, state[key])
+    index_holdings(guild_id)
+    dict.__setitem__(currency_index, guild_id, NameIndex(state["currencies"]))
+    cooldown_engine.schedule_guild(guild_id)
+
+
+def index_holdings(guild_id):
+    """Rebuild a loaded guild's holdings index from its balances."""
+    guild_holdings = {}
+    for name, data in dict.get(currencies_data, guild_id, {}).items():
+        for user_id, amount in data["balances"].items():
+            if amount:
+                guild_holdings.setdefault(user_id, set()).add(name)
+    dict.__setitem__(holdings, guild_id, guild_holdings)
+
+
+# --- Guild Residency ---
+# Interactions load their guild through load_guild() before the handler runs, which reads
+# cold guilds in a worker thread; ensure_guild_loaded() is the synchronous fallback for any
+# other access. Loaded guilds in least- to most-recently used order: { guild_id: last_access_monotonic }
+loaded_guilds = OrderedDict()
+# Writer submission count at the time each guild was evicted, so a reload can wait for those rows
+evicted_at = {}
+# guild_id -> asyncio.Task of a cold load running in a worker thread
+guild_loads = {}
+
+MAX_LOADED_GUILDS = 500
+MAX_LOADED_ROWS = 2_000_000  # rough memory budget across all loaded guilds
+GUILD_MIN_IDLE_SECONDS = 300  # never evict a guild used more recently than this
+EVICTION_INTERVAL = 60  # seconds between eviction sweeps
+
+
+def fetch_guild_state(guild_id):
+    """
+    Read a cold guild's state without installing it; returns (state, source). Blocks on
+    SQLite and possibly on the writer, so the event loop calls it through load_guild().
+    """
+    # A guild that was never evicted still matches the boot snapshot, if there is one
+    if guild_id not in evicted_at and snapshot.is_open():
+        state = snapshot.read_guild(guild_id)
+        if state is not None:
+            return state, "snapshot"
+
+    # Rows this guild queued before it was evicted must reach SQLite before we read them back
+    if evicted_at.get(guild_id, 0) > db_writer.committed:
+        db_writer.flush()
+    with db.lock:
+        return read_guild_state(db.connect(), guild_id), "sqlite"
+
+
+def install_loaded_guild(guild_id, state, source, started):
+    # Marked loaded only once its rows were read, so a failed read never leaves an empty guild
+    # behind for later saves to write over the real rows
+    loaded_guilds[guild_id] = time.monotonic()
+    try:
+        install_guild_state(guild_id, state)
+    except BaseException:
+        drop_guild_state(guild_id)
+        raise
+    metrics.observe("currencybot_guild_load_seconds", time.perf_counter() - started, (("source", source),))
 
 
-    conn.commit()
-    conn.close()
+def ensure_guild_loaded(guild_id):
+    if guild_id in loaded_guilds:
+        loaded_guilds.move_to_end(guild_id)
+        loaded_guilds[guild_id] = time.monotonic()
+        return
+    started = time.perf_counter()
+    state, source = fetch_guild_state(guild_id)
+    install_loaded_guild(guild_id, state, source, started)
 
 
-def save_guild_cooldowns():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+async def load_guild(guild_id):
+    """Make sure a guild is loaded, reading a cold one in a worker thread instead of on the event loop."""
+    if guild_id is None or guild_id in loaded_guilds:
+        return
+    task = guild_loads.get(guild_id)
+    if task is None:
+        task = guild_loads[guild_id] = asyncio.create_task(load_guild_in_thread(guild_id))
+        task.add_done_callback(lambda _: guild_loads.pop(guild_id, None))
+    await asyncio.shield(task)
 
-    # Insert or update cooldowns
-    for guild_id, cds in guild_cooldowns.items():
-        # Ensure rob exists in dict
-        rob_cd = cds.get("rob", 21600)
-        c.execute("""
-        INSERT INTO guild_settings (guild_id, homework_cooldown, officehours_cooldown, rob_cooldown)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(guild_id) DO UPDATE SET
-            homework_cooldown=excluded.homework_cooldown,
-            officehours_cooldown=excluded.officehours_cooldown,
-            rob_cooldown=excluded.rob_cooldown
-        """, (guild_id, cds["homework"], cds["officehours"], rob_cd))
 
-    conn.commit()
-    conn.close()
+async def load_guild_in_thread(guild_id):
+    started = time.perf_counter()
+    state, source = await asyncio.to_thread(fetch_guild_state, guild_id)
+    # A synchronous access may have loaded it while the thread was reading
+    if guild_id not in loaded_guilds:
+        install_loaded_guild(guild_id, state, source, started)
+
+
+def guild_row_count(guild_id):
+    """Approximate number of rows a loaded guild holds in memory."""
+    rows = 1
+    for data in dict.get(currencies_data, guild_id, {}).values():
+        rows += 1 + len(data["balances"])
+    for state_map in (cooldowns, jackpots, inventories, active_buffs):
+        rows += len(dict.get(state_map, guild_id, ()))
+    return rows
+
+
+def evict_guild(guild_id):
+    """Flush and drop a guild's in-memory state; it is reloaded on next access."""
+    save_db()
+    evicted_at[guild_id] = db_writer.submitted
+    drop_guild_state(guild_id)
+
+
+def drop_guild_state(guild_id):
+    for state_map in GUILD_STATE_MAPS:
+        dict.pop(state_map, guild_id, None)
+    dict.pop(holdings, guild_id, None)
+    dict.pop(currency_index, guild_id, None)
+    render_cache.forget_guild(guild_id)
+    loaded_guilds.pop(guild_id, None)
+
+
+def evict_cold_guilds():
+    """Evict least-recently used guilds until the loaded set fits the count and row budgets."""
+    rows = sum(guild_row_count(guild_id) for guild_id in loaded_guilds)
+    now = time.monotonic()
+    evicted = 0
+    while loaded_guilds and (len(loaded_guilds) > MAX_LOADED_GUILDS or rows > MAX_LOADED_ROWS):
+        guild_id, last_access = next(iter(loaded_guilds.items()))
+        if now - last_access < GUILD_MIN_IDLE_SECONDS:
+            break
+        rows -= guild_row_count(guild_id)
+        evict_guild(guild_id)
+        evicted += 1
+    return evicted
+
+
+async def eviction_loop():
+    while True:
+        await asyncio.sleep(EVICTION_INTERVAL)
+        evict_cold_guilds()
+
+
+# --- Change Tracking ---
+# Every mutation of the in-memory state marks the (table, key) cell it touched.
+# save_db() then reads back only those cells and upserts or deletes their rows.
+# Format: { ("balances", guild_id, user_id, currency), ("jackpots", guild_id, currency), ... }
+dirty_cells = set()
+
+# Primary key and value columns of every table save_db() writes.
+TABLE_COLUMNS = {
+    "currencies": (("guild_id", "name"), ("emoji",)),
+    "balances": (("guild_id", "user_id", "currency"), ("amount",)),
+    "cooldowns": (("guild_id", "user_id", "command"), ("last_used",)),
+    "jackpots": (("guild_id", "currency"), ("amount",)),
+    "inventories": (("guild_id", "user_id", "item"), ("quantity",)),
+    "active_buffs": (("guild_id", "user_id", "buff_name"), ()),
+    "guild_settings": (("guild_id",), ("homework_cooldown", "officehours_cooldown", "rob_cooldown")),
+    "ledger": (("id",), ("guild_id", "from_user", "to_user", "currency", "amount", "reason", "ts")),
+}
+
+
+def mark_dirty(table, *key):
+    """Record that the row with this primary key must be rewritten on the next save."""
+    dirty_cells.add((table,) + key)
+
+
+def read_cell(table, key):
+    """Return the value columns currently held in memory for a row, or None if it no longer exists."""
+    if table == "currencies":
+        guild_id, name = key
+        data = currencies_data.get(guild_id, {}).get(name)
+        return None if data is None else (data.get("emoji", ""),)
+    if table == "balances":
+        guild_id, user_id, currency = key
+        data = currencies_data.get(guild_id, {}).get(currency)
+        if data is None or user_id not in data["balances"]:
+            return None
+        return (data["balances"][user_id],)
+    if table == "cooldowns":
+        guild_id, user_id, command = key
+        last_used = cooldowns.get(guild_id, {}).get(user_id, {}).get(command)
+        return None if last_used is None else (last_used,)
+    if table == "jackpots":
+        guild_id, currency = key
+        amount = jackpots.get(guild_id, {}).get(currency)
+        return None if amount is None else (amount,)
+    if table == "inventories":
+        guild_id, user_id, item = key
+        qty = inventories.get(guild_id, {}).get(user_id, {}).get(item, 0)
+        return (qty,) if qty > 0 else None
+    if table == "active_buffs":
+        guild_id, user_id, buff_name = key
+        return () if buff_name in active_buffs.get(guild_id, {}).get(user_id, set()) else None
+    if table == "guild_settings":
+        (guild_id,) = key
+        cds = guild_cooldowns.get(guild_id)
+        if cds is None:
+            return None
+        return (cds["homework"], cds["officehours"], cds.get("rob", COOLDOWN_SECONDS))
+    raise ValueError(f"Unknown table {table}")
+
+
+@lru_cache(maxsize=None)
+def upsert_sql(table):
+    keys, values = TABLE_COLUMNS[table]
+    columns = keys + values
+    return f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+
+@lru_cache(maxsize=None)
+def delete_sql(table):
+    keys, _ = TABLE_COLUMNS[table]
+    return f"DELETE FROM {table} WHERE {' AND '.join(f'{k}=?' for k in keys)}"
+
+
+# --- Ledger ---
+# Every transfer is appended as a ledger row that rides along with the next change set,
+# so it is journaled and batched into SQLite together with the balances it explains.
+# from_user / to_user is NULL for currency the bot creates or destroys, and
+# JACKPOT_ACCOUNT (0) for a guild's jackpot pot.
+
+class Ledger:
+    def __init__(self):
+        self.next_id = 1
+        self.entries = []  # ledger row changes not yet handed to the writer
+
+    def seed(self, conn):
+        """Continue numbering after the last row in the database."""
+        self.next_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM ledger").fetchone()[0]
+        self.entries.clear()
+
+    def record(self, guild_id, from_user, to_user, currency, amount, reason):
+        # Transfers validate their amounts, so anything else here is a bug that would leave
+        # a balance change unexplained by the ledger
+        if amount <= 0:
+            raise ValueError(f"Ledger amount must be positive, not {amount} ({reason})")
+        values = (guild_id, from_user, to_user, currency, amount, reason, time.time())
+        self.entries.append(("ledger", (self.next_id,), values))
+        self.next_id += 1
+
+    def take(self):
+        entries, self.entries = self.entries, []
+        return entries
+
+
+ledger = Ledger()
+
+HISTORY_SQL = """
+    SELECT * FROM (SELECT from_user, to_user, currency, amount, reason, ts FROM ledger
+                   WHERE guild_id = ? AND from_user = ? ORDER BY ts DESC LIMIT ?)
+    UNION ALL
+    SELECT * FROM (SELECT from_user, to_user, currency, amount, reason, ts FROM ledger
+                   WHERE guild_id = ? AND to_user = ? ORDER BY ts DESC LIMIT ?)
+    ORDER BY ts DESC LIMIT ?
+"""
+AUDIT_SUMMARY_SQL = """
+    SELECT reason, COUNT(*), SUM(amount) FROM ledger
+    WHERE guild_id = ? AND currency = ? AND ts >= ?
+    GROUP BY reason ORDER BY SUM(amount) DESC
+"""
+AUDIT_RECENT_SQL = """
+    SELECT from_user, to_user, currency, amount, reason, ts FROM ledger
+    WHERE guild_id = ? AND currency = ? AND ts >= ?
+    ORDER BY ts DESC LIMIT ?
+"""
+
+
+async def query_ledger(*queries):
+    """
+    Run (sql, params) queries on a separate read connection off the event loop, once every
+    entry recorded so far has reached SQLite. Returns one list of rows per query.
+    """
+    save_db()
+
+    def run():
+        db_writer.flush()
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            return [conn.execute(sql, params).fetchall() for sql, params in queries]
+        finally:
+            conn.close()
+
+    return await asyncio.to_thread(run)
+
+
+def describe_account(account):
+    if account is None:
+        return "🏦 bot"
+    if account == JACKPOT_ACCOUNT:
+        return "🎰 jackpot"
+    return f"<@{account}>"
+
+
+def format_ledger_row(row):
+    from_user, to_user, currency, amount, reason, ts = row
+    return f"<t:{int(ts)}:R> `{reason}` {describe_account(from_user)} → {describe_account(to_user)}: **{amount} {currency}**"
+
+
+def parse_since(text):
+    """Turn "24h", "7d", "30m" or an ISO date into a unix timestamp, or None if it can't be parsed."""
+    match = re.fullmatch(r"\s*(\d+)\s*([mhd])\s*", text.lower())
+    if match:
+        seconds = int(match.group(1)) * {"m": 60, "h": 3600, "d": 86400}[match.group(2)]
+        return time.time() - seconds
+    try:
+        return datetime.fromisoformat(text.strip()).timestamp()
+    except ValueError:
+        return None
+
+
+# --- Render Cache ---
+# Read-only commands cache the expensive part of their embed (the description or fields)
+# per (guild, view key). Each body records the version stamps of the topics it was built
+# from, e.g. "currencies" or ("balances", name); the state mutators bump those topics, so
+# a stale body is simply never matched again. Only the requester footer and timestamp are
+# applied per call.
+
+RENDER_CACHE_SIZE = 5000  # bodies kept across all guilds
+
+FOOTER_TEXT = "Currencies in this bot have no value and are not sponsored by the ECE department.\n"
+
+
+def add_footer(embed, user):
+    """Stamp the requester footer and timestamp that every embed carries."""
+    embed.set_footer(
+        text=f"Requested by {user}\n{FOOTER_TEXT}",
+        icon_url=user.avatar.url if user.avatar else None
+    )
+    embed.timestamp = datetime.now()
+    return embed
+
+
+class RenderCache:
+    def __init__(self, capacity=RENDER_CACHE_SIZE):
+        self.capacity = capacity
+        self.clock = 0
+        # Stamps come from one increasing clock, so a topic dropped and re-created never
+        # reuses a stamp a cached body still holds
+        self.versions = {}  # (guild_id, topic) -> stamp, only for topics some body was built from
+        self.bodies = OrderedDict()  # (guild_id, view) -> (topics, stamps, body)
+
+    def tick(self):
+        self.clock += 1
+        return self.clock
+
+    def bump(self, guild_id, topic):
+        key = (guild_id, topic)
+        if key in self.versions:
+            self.versions[key] = self.tick()
+
+    def lookup(self, guild_id, view, topics):
+        """(body or None, stamps); hand the stamps back to store() with the body built on a miss."""
+        stamps = []
+        for topic in topics:
+            key = (guild_id, topic)
+            stamp = self.versions.get(key)
+            if stamp is None:
+                stamp = self.versions[key] = self.tick()
+            stamps.append(stamp)
+        stamps = tuple(stamps)
+
+        entry = self.bodies.get((guild_id, view))
+        hit = entry is not None and entry[1] == stamps
+        metrics.inc("currencybot_render_cache_total", (("view", view[0]), ("result", "hit" if hit else "miss")))
+        if not hit:
+            return None, stamps
+        self.bodies.move_to_end((guild_id, view))
+        return entry[2], stamps
+
+    def store(self, guild_id, view, topics, stamps, body):
+        self.bodies[(guild_id, view)] = (topics, stamps, body)
+        self.bodies.move_to_end((guild_id, view))
+        while len(self.bodies) > self.capacity:
+            (old_guild, _), (old_topics, _, _) = self.bodies.popitem(last=False)
+            # Per-user topics would otherwise pile up; the shared ones are few
+            for topic in old_topics:
+                if topic[0] == "user":
+                    self.versions.pop((old_guild, topic), None)
+        return body
+
+    def forget_guild(self, guild_id):
+        for key in [key for key in self.bodies if key[0] == guild_id]:
+            del self.bodies[key]
+        for key in [key for key in self.versions if key[0] == guild_id]:
+            del self.versions[key]
+
+    def clear(self):
+        self.bodies.clear()
+        self.versions.clear()
+
+
+render_cache = RenderCache()
+
+
+def cached_render(guild_id, view, topics, build):
+    """The body for `view`, rebuilt by build() only when one of its topics changed."""
+    body, stamps = render_cache.lookup(guild_id, view, topics)
+    if body is None:
+        body = render_cache.store(guild_id, view, topics, stamps, build())
+    return body
+
+
+# --- State Mutators ---
+# Handlers change persistent state only through these so every change is tracked.
+
+def set_user_balance(guild_id, currency, user_id, amount):
+    currencies_data[guild_id][currency]["balances"][user_id] = amount
+    set_holding(guild_id, user_id, currency, amount != 0)
+    mark_dirty("balances", guild_id, user_id, currency)
+    dict.__getitem__(currency_index, guild_id).touch(currency)  # recently used currencies autocomplete first
+    render_cache.bump(guild_id, ("balances", currency))
+    render_cache.bump(guild_id, ("user", user_id))
+
+
+def set_holding(guild_id, user_id, currency, held):
+    guild_holdings = holdings.setdefault(guild_id, {})
+    if held:
+        guild_holdings.setdefault(user_id, set()).add(currency)
+    elif currency in guild_holdings.get(user_id, ()):
+        guild_holdings[user_id].discard(currency)
+        if not guild_holdings[user_id]:
+            del guild_holdings[user_id]
+
+
+def held_currencies(guild_id, user_id):
+    """Names of the currencies a user has a nonzero balance in, alphabetically."""
+    return sorted(holdings.get(guild_id, {}).get(user_id, ()))
+
+
+def add_user_balance(guild_id, currency, user_id, delta):
+    """Add delta to a user's balance and return the new amount."""
+    balances = currencies_data[guild_id][currency]["balances"]
+    amount = balances.get(user_id, 0) + delta
+    set_user_balance(guild_id, currency, user_id, amount)
+    return amount
+
+
+def set_cooldown_stamp(command, guild_id, user_id, last_used):
+    """Stamp a command cooldown; last_used=None clears it. Handlers go through cooldown_engine."""
+    guild_timers = cooldowns.setdefault(guild_id, {})
+    if last_used is None:
+        user_timers = guild_timers.get(user_id, {})
+        user_timers.pop(command, None)
+        if not user_timers:
+            guild_timers.pop(user_id, None)
+    else:
+        guild_timers.setdefault(user_id, {})[command] = last_used
+    mark_dirty("cooldowns", guild_id, user_id, command)
+
+
+def set_jackpot(guild_id, currency, amount):
+    jackpots.setdefault(guild_id, {})[currency] = amount
+    mark_dirty("jackpots", guild_id, currency)
+    render_cache.bump(guild_id, "jackpots")
+
+
+def set_inventory_qty(guild_id, user_id, item, qty):
+    """Set how many of an item a user owns; a quantity of 0 removes the item."""
+    user_inv = inventories.setdefault(guild_id, {}).setdefault(user_id, {})
+    if qty > 0:
+        user_inv[item] = qty
+    else:
+        user_inv.pop(item, None)
+    mark_dirty("inventories", guild_id, user_id, item)
+
+
+def set_buff(guild_id, user_id, buff_name, active):
+    user_buffs = active_buffs.setdefault(guild_id, {}).setdefault(user_id, set())
+    if active:
+        user_buffs.add(buff_name)
+    else:
+        user_buffs.discard(buff_name)
+    mark_dirty("active_buffs", guild_id, user_id, buff_name)
+
+
+def set_guild_cooldown(guild_id, command, seconds):
+    cds = guild_cooldowns.setdefault(guild_id, {
+        "homework": COOLDOWN_SECONDS,
+        "officehours": COOLDOWN_SECONDS,
+        "rob": COOLDOWN_SECONDS  # Default 6 hours
+    })
+    cds[command] = seconds
+    mark_dirty("guild_settings", guild_id)
+
+
+def add_guild_currency(guild_id, name, emoji):
+    currencies_data.setdefault(guild_id, {})[name] = {"emoji": emoji, "balances": BalanceStore()}
+    mark_dirty("currencies", guild_id, name)
+    render_cache.bump(guild_id, "currencies")
+    currency_index.setdefault(guild_id, NameIndex()).add(name)
+
+
+def remove_guild_currency(guild_id, name):
+    """Delete a currency and every balance held in it."""
+    data = currencies_data[guild_id].pop(name)
+    mark_dirty("currencies", guild_id, name)
+    if jackpots.get(guild_id, {}).pop(name, None) is not None:
+        mark_dirty("jackpots", guild_id, name)
+        render_cache.bump(guild_id, "jackpots")
+    render_cache.bump(guild_id, "currencies")
+    currency_index[guild_id].remove(name)
+    for user_id in data["balances"]:
+        set_holding(guild_id, user_id, name, False)
+        mark_dirty("balances", guild_id, user_id, name)
+
+
+def rename_guild_currency(guild_id, old_name, new_name):
+    """Move a currency and its balances to a new name."""
+    guild_currencies = currencies_data[guild_id]
+    guild_currencies[new_name] = guild_currencies.pop(old_name)
+    mark_dirty("currencies", guild_id, old_name)
+    mark_dirty("currencies", guild_id, new_name)
+    # The pot follows the currency, replacing any pot left behind under the new name
+    guild_pots = jackpots.get(guild_id, {})
+    if old_name in guild_pots or new_name in guild_pots:
+        pot = guild_pots.pop(old_name, None)
+        if pot is None:
+            del guild_pots[new_name]
+        else:
+            guild_pots[new_name] = pot
+        mark_dirty("jackpots", guild_id, old_name)
+        mark_dirty("jackpots", guild_id, new_name)
+        render_cache.bump(guild_id, "jackpots")
+    render_cache.bump(guild_id, "currencies")
+    currency_index[guild_id].rename(old_name, new_name)
+    for user_id, amount in guild_currencies[new_name]["balances"].items():
+        if amount:
+            set_holding(guild_id, user_id, old_name, False)
+            set_holding(guild_id, user_id, new_name, True)
+        mark_dirty("balances", guild_id, user_id, old_name)
+        mark_dirty("balances", guild_id, user_id, new_name)
+
+
+def collect_changes():
+    """Turn the dirty cells into row changes: (table, key, values), with values=None meaning delete."""
+    changes = [(cell[0], cell[1:], read_cell(cell[0], cell[1:])) for cell in dirty_cells]
+    dirty_cells.clear()
+    changes.extend(ledger.take())
+    return changes
+
+
+def write_changes(conn, changes):
+    """Apply { (table, key): values } in one transaction; values=None deletes the row."""
+    upserts = {}
+    deletes = {}
+    for (table, key), values in changes.items():
+        if values is None:
+            deletes.setdefault(table, []).append(key)
+        else:
+            upserts.setdefault(table, []).append(key + values)
+
+    with conn:
+        for table, rows in deletes.items():
+            conn.executemany(delete_sql(table), rows)
+        for table, rows in upserts.items():
+            conn.executemany(upsert_sql(table), rows)
+        bump_generation(conn)
+
+
+def bump_generation(conn):
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+
+def db_generation(conn):
+    return conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
 
 
 def save_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    """Queue the cells changed since the last save for the background writer."""
+    if dirty_cells or ledger.entries:
+        started = time.perf_counter()
+        db_writer.submit(collect_changes())
+        metrics.observe("currencybot_save_db_seconds", time.perf_counter() - started)
 
-    c.execute("DELETE FROM currencies")
-    c.execute("DELETE FROM balances")
-    c.execute("DELETE FROM cooldowns")
-    c.execute("DELETE FROM jackpots")
 
-    # --- Save currencies & balances ---
-    for guild_id, guild_currencies in currencies_data.items():
-        for currency_name, data in guild_currencies.items():
-            emoji = data.get("emoji", "")
-            balances = data.get("balances", {})
+def resolve_future(future, error):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
 
-            c.execute("INSERT INTO currencies VALUES (?, ?, ?)", (guild_id, currency_name, emoji))
 
-            for user_id, amount in balances.items():
-                c.execute(
-                    "INSERT INTO balances VALUES (?, ?, ?, ?)",
-                    (guild_id, user_id, currency_name, amount)
-                )
+class PersistenceError(RuntimeError):
+    """The background writer has stopped, so changes can no longer be made durable."""
 
-    # --- Save cooldowns ---
-    for guild_id, users in hw_cooldowns.items():
-        for user_id, last_used in users.items():
-            c.execute(
-                "INSERT OR REPLACE INTO cooldowns VALUES (?, ?, ?, ?)",
-                (guild_id, user_id, "homework", last_used)
-            )
 
-    for guild_id, users in office_cooldowns.items():
-        for user_id, last_used in users.items():
-            c.execute(
-                "INSERT OR REPLACE INTO cooldowns VALUES (?, ?, ?, ?)",
-                (guild_id, user_id, "officehours", last_used)
-            )
+def commit_db():
+    """
+    Queue the cells changed since the last save; returns a future to await until they are
+    durable in the journal. The changes are queued by the call itself, not by the await.
+    Raises PersistenceError if the writer has died, rather than confirming unsaved changes.
+    """
+    loop = asyncio.get_running_loop()
+    durable = loop.create_future()
+    if not dirty_cells and not ledger.entries:
+        durable.set_result(None)
+        return durable
+    if not db_writer.is_alive():
+        if db_writer.ident is not None:
+            # It ran and stopped: nothing reads its queue any more
+            print("❌ DB writer is not running; changes cannot be saved")
+            raise PersistenceError("The database writer has stopped; changes cannot be saved.")
+        save_db()  # not started yet; the writer picks these up once it starts
+        durable.set_result(None)
+        return durable
+
+    def on_durable(error):
+        try:
+            loop.call_soon_threadsafe(resolve_future, durable, error)
+        except RuntimeError:  # loop already closed during shutdown
+            pass
+
+    started = time.perf_counter()
+    db_writer.submit(collect_changes(), on_durable)
+    durable.add_done_callback(
+        lambda _: metrics.observe("currencybot_commit_seconds", time.perf_counter() - started))
+    return durable
+
+
+def compact_db():
+    """
+    Rewrite every loaded guild's rows from memory, dropping any rows the delta saves left behind.
+    Guilds load lazily, so only guilds currently in memory are rewritten; compact_all_guilds()
+    covers the whole database.
+    """
+    rows = {table: [] for table in TABLE_COLUMNS if table != "ledger"}  # the ledger is append-only
 
-    # ✅ Save rob cooldowns
-    for guild_id, users in rob_cooldowns.items():
-        for user_id, last_used in users.items():
-            c.execute(
-                "INSERT OR REPLACE INTO cooldowns VALUES (?, ?, ?, ?)",
-                (guild_id, user_id, "rob", last_used)
-            )
+    # --- Save currencies & balances ---
+    for guild_id, guild_currencies in dict.items(currencies_data):
+        for currency_name, data in guild_currencies.items():
+            rows["currencies"].append((guild_id, currency_name, data.get("emoji", "")))
+            for user_id, amount in data.get("balances", {}).items():
+                rows["balances"].append((guild_id, user_id, currency_name, amount))
+
+    # --- Save cooldowns ---
+    for guild_id, users in dict.items(cooldowns):
+        for user_id, timers in users.items():
+            for command, last_used in timers.items():
+                rows["cooldowns"].append((guild_id, user_id, command, last_used))
 
     # --- Save jackpots ---
-    for guild_id, guild_pots in jackpots.items():
+    for guild_id, guild_pots in dict.items(jackpots):
         for currency, amount in guild_pots.items():
-            c.execute(
-                "REPLACE INTO jackpots (guild_id, currency, amount) VALUES (?, ?, ?)",
-                (guild_id, currency, amount)
-            )
-    
-    c.execute("DELETE FROM inventories")
-    for guild_id, users in inventories.items():
+            rows["jackpots"].append((guild_id, currency, amount))
+
+    for guild_id, users in dict.items(inventories):
         for user_id, items in users.items():
             for item_name, qty in items.items():
-                c.execute(
-                    "INSERT INTO inventories VALUES (?, ?, ?, ?)",
-                    (guild_id, user_id, item_name, qty)
-                )
+                rows["inventories"].append((guild_id, user_id, item_name, qty))
 
     # --- Save Active Buffs ---
-    c.execute("DELETE FROM active_buffs")
-    for guild_id, users in active_buffs.items():
+    for guild_id, users in dict.items(active_buffs):
         for user_id, buffs in users.items():
             for buff_name in buffs:
-                c.execute(
-                    "INSERT INTO active_buffs VALUES (?, ?, ?)",
-                    (guild_id, user_id, buff_name)
-            )
+                rows["active_buffs"].append((guild_id, user_id, buff_name))
 
+    for guild_id in dict.keys(guild_cooldowns):
+        rows["guild_settings"].append((guild_id,) + read_cell("guild_settings", (guild_id,)))
 
-    conn.commit()
-    conn.close()
+    # Journal whatever is dirty first so a replay never rolls these cells back
+    save_db()
+    db_writer.submit_compact(list(loaded_guilds), rows)
+
+
+def compact_all_guilds():
+    """
+    Compact every guild in the database, loading MAX_LOADED_GUILDS at a time. Run by
+    `python code.py --compact` while the bot is stopped; returns the number of guilds.
+    """
+    with db.lock:
+        conn = db.connect()
+        guild_ids = sorted({guild_id for table in TABLE_COLUMNS if table != "ledger"
+                            for (guild_id,) in conn.execute(f"SELECT DISTINCT guild_id FROM {table}")})
+    for start in range(0, len(guild_ids), MAX_LOADED_GUILDS):
+        for guild_id in guild_ids[start:start + MAX_LOADED_GUILDS]:
+            ensure_guild_loaded(guild_id)
+        compact_db()
+        for guild_id in list(loaded_guilds):
+            evict_guild(guild_id)
+    db_writer.flush()
+    return len(guild_ids)
+
+
+# --- Mutation Journal ---
+# Every change set is appended here and fsync'd before its command is acknowledged,
+# so SQLite itself can be written lazily. load_db() replays the journal over the last
+# SQLite commit; it is truncated whenever SQLite has caught up and been checkpointed.
+# Record format: <payload length: u32><crc32: u32><JSON list of [table, key, values]>
+
+class Journal:
+    HEADER = struct.Struct("<II")
+
+    def __init__(self):
+        self.file = None
+
+    def open(self):
+        if self.file is None:
+            self.file = open(JOURNAL_PATH, "ab")
+
+    def append(self, changes):
+        payload = json.dumps(changes, separators=(",", ":")).encode()
+        self.file.write(self.HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def truncate(self):
+        if self.file is None:
+            with open(JOURNAL_PATH, "wb") as f:
+                os.fsync(f.fileno())
+            return
+        self.file.truncate(0)
+        self.sync()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def read(self):
+        """Yield each intact change set in order, stopping at a torn or corrupt tail."""
+        if not os.path.exists(JOURNAL_PATH):
+            return
+        with open(JOURNAL_PATH, "rb") as f:
+            data = f.read()
+        pos = 0
+        while pos + self.HEADER.size <= len(data):
+            length, crc = self.HEADER.unpack_from(data, pos)
+            payload = data[pos + self.HEADER.size:pos + self.HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                print(f"⚠️ Ignoring torn journal tail at byte {pos}")
+                return
+            yield json.loads(payload)
+            pos += self.HEADER.size + length
+
+
+journal = Journal()
+
+
+def replay_journal(conn):
+    """Apply journaled changes over the SQLite snapshot, then start a fresh journal once they are checkpointed."""
+    changes = {}
+    for change_set in journal.read():
+        for table, key, values in change_set:
+            changes[(table, tuple(key))] = None if values is None else tuple(values)
+    if changes:
+        print(f"🔁 Replaying {len(changes)} journaled changes")
+        write_changes(conn, changes)
+        # Until a checkpoint succeeds the replayed rows may not be durable; keep the journal
+        # so they replay again, and the writer truncates it after its next good checkpoint
+        if not db.checkpoint(force=True):
+            print("⚠️ Checkpoint busy after journal replay; keeping the journal")
+            return
+    journal.truncate()
+
+
+# --- Binary Snapshot ---
+# A checksummed image of every guild's state, written on clean shutdown and every
+# SNAPSHOT_INTERVAL seconds, so restarts can skip rebuilding guilds row by row.
+# ensure_guild_loaded() decodes guilds straight out of the memory-mapped file as long as
+# the snapshot's generation matches the database's; otherwise it falls back to SQLite.
+# Layout: header | guild segments (marshal of read_guild_state()) | index of
+# (guild_id, offset, length, crc32) per guild | crc32 of the index.
+
+SNAPSHOT_MAGIC = b"CBSNAP"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_INTERVAL = 30 * 60  # seconds
+
+
+class Snapshot:
+    HEADER = struct.Struct("<6sHHqQII")  # magic, version, marshal version, generation, index offset, guilds, index crc
+    ENTRY = struct.Struct("<qQII")  # guild_id, offset, length, crc32
+
+    def __init__(self):
+        self.file = None
+        self.data = None
+        self.index = None  # guild_id -> (offset, length, crc32)
+
+    def is_open(self):
+        return self.index is not None
+
+    def open(self, generation):
+        """Map SNAPSHOT_PATH if it is intact and was taken at this database generation."""
+        self.close()
+        if not os.path.exists(SNAPSHOT_PATH) or os.path.getsize(SNAPSHOT_PATH) < self.HEADER.size:
+            return False
+        self.file = open(SNAPSHOT_PATH, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, marshal_version, snap_generation, index_offset, guilds, index_crc = \
+            self.HEADER.unpack_from(self.data, 0)
+        index_end = index_offset + guilds * self.ENTRY.size
+        if (magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or marshal_version != marshal.version
+                or index_end > len(self.data) or zlib.crc32(self.data[index_offset:index_end]) != index_crc):
+            print("⚠️ Snapshot is corrupt or from another version; loading from SQLite")
+            self.close()
+            return False
+        if snap_generation != generation:
+            print("⚠️ Snapshot is stale; loading from SQLite")
+            self.close()
+            return False
+
+        self.index = {}
+        for i in range(guilds):
+            guild_id, offset, length, crc = self.ENTRY.unpack_from(self.data, index_offset + i * self.ENTRY.size)
+            self.index[guild_id] = (offset, length, crc)
+        return True
+
+    def read_guild(self, guild_id):
+        """Return the guild's state, an empty state if the snapshot has no rows for it, or None if corrupt."""
+        entry = self.index.get(guild_id)
+        if entry is None:
+            return {key: {} for key in GUILD_STATE_KEYS}
+        offset, length, crc = entry
+        segment = self.data[offset:offset + length]
+        if zlib.crc32(segment) != crc:
+            print(f"⚠️ Snapshot segment for guild {guild_id} is corrupt; loading from SQLite")
+            return None
+        return marshal.loads(segment)
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.file.close()
+        self.file = self.data = self.index = None
+
+
+snapshot = Snapshot()
+
+
+def write_snapshot(conn):
+    """Write a snapshot of everything in SQLite, as seen by one read transaction on conn."""
+    tmp_path = SNAPSHOT_PATH + ".tmp"
+    with conn:
+        conn.execute("BEGIN")  # one consistent view while we read every guild
+        generation = db_generation(conn)
+        guild_ids = [row[0] for row in conn.execute(
+            "SELECT guild_id FROM currencies UNION SELECT guild_id FROM guild_settings "
+            "UNION SELECT guild_id FROM cooldowns UNION SELECT guild_id FROM jackpots "
+            "UNION SELECT guild_id FROM inventories UNION SELECT guild_id FROM active_buffs"
+        )]
+        with open(tmp_path, "wb") as f:
+            f.write(bytes(Snapshot.HEADER.size))
+            index = bytearray()
+            for guild_id in guild_ids:
+                segment = marshal.dumps(read_guild_state(conn, guild_id))
+                index += Snapshot.ENTRY.pack(guild_id, f.tell(), len(segment), zlib.crc32(segment))
+                f.write(segment)
+            index_offset = f.tell()
+            f.write(index)
+            f.seek(0)
+            f.write(Snapshot.HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, marshal.version, generation,
+                                         index_offset, len(guild_ids), zlib.crc32(index)))
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, SNAPSHOT_PATH)
+
+
+def snapshot_loop():
+    """Periodically snapshot from a separate read connection so the writer is never held up."""
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        conn = sqlite3.connect(DB_PATH, isolation_level=None)
+        try:
+            write_snapshot(conn)
+        except (sqlite3.Error, OSError) as e:
+            print(f"❌ Snapshot failed: {e}")
+        finally:
+            conn.close()
+
+
+# --- Background Writer ---
+# Handlers never touch SQLite themselves: save_db() hands row changes to this thread,
+# which journals them immediately and coalesces everything arriving within
+# FLUSH_INTERVAL (or FLUSH_MAX_CHANGES rows) into a single SQLite transaction.
+
+FLUSH_INTERVAL = 1.0  # seconds; the journal keeps acknowledged changes durable meanwhile
+FLUSH_MAX_CHANGES = 1000
+JOURNAL_BATCH = 64  # max change sets per journal fsync
+
+
+class DBWriter(threading.Thread):
+    def __init__(self, interval=FLUSH_INTERVAL, max_changes=FLUSH_MAX_CHANGES):
+        super().__init__(name="db-writer", daemon=True)
+        self.interval = interval
+        self.max_changes = max_changes
+        self.queue = queue.Queue()
+        self.pending = {}  # (table, key) -> values, later changes overwrite earlier ones
+        self.unsynced = []  # on_durable callbacks waiting for the next journal fsync
+        self.unsynced_sets = 0
+        self.submitted = 0  # change sets handed to the writer
+        self.accepted = 0  # change sets merged into pending
+        self.committed = 0  # change sets written to SQLite
+
+    def submit(self, changes, on_durable=None):
+        self.submitted += 1
+        self.queue.put(("changes", (changes, on_durable)))
+
+    def submit_compact(self, guild_ids, rows):
+        self.queue.put(("compact", (guild_ids, rows)))
+
+    def flush(self):
+        """Block until everything submitted so far has been committed."""
+        if not self.is_alive():
+            return
+        done = threading.Event()
+        self.queue.put(("flush", done))
+        done.wait()
+
+    def stop(self):
+        """Drain the queue, commit it and stop the thread."""
+        if self.is_alive():
+            self.queue.put(("stop", None))
+            self.join()
+
+    def run(self):
+        conn = db.connect()
+        journal.open()
+        deadline = None
+        try:
+            while True:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    kind, payload = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    kind, payload = "timeout", None
+
+                if kind == "changes":
+                    self.accept(*payload)
+                    # Group commit: one fsync covers every change set queued so far
+                    if self.queue.empty() or self.unsynced_sets >= JOURNAL_BATCH:
+                        self.sync_journal()
+                    if deadline is None:
+                        deadline = time.monotonic() + self.interval
+                    if len(self.pending) < self.max_changes:
+                        continue
+                elif kind == "compact":
+                    self.sync_journal()
+                    self.write_pending(conn)
+                    self.write_compact(conn, *payload)
+                elif kind == "flush":
+                    self.sync_journal()
+                    self.write_pending(conn)
+                    payload.set()
+                    continue
+                elif kind == "stop":
+                    break
+
+                self.write_pending(conn)
+                deadline = None
+        finally:
+            self.drain()
+            self.sync_journal()
+            self.write_pending(conn)
+            try:
+                snapshot.close()
+                with db.lock:
+                    write_snapshot(conn)
+            except (sqlite3.Error, OSError) as e:
+                print(f"❌ Snapshot failed: {e}")
+            if db.checkpoint(force=True):
+                journal.truncate()
+            db.close()
+            journal.close()
+
+    def accept(self, changes, on_durable):
+        try:
+            journal.append(changes)
+        except OSError as e:
+            print(f"❌ Journal write failed: {e}")
+            if on_durable:
+                on_durable(e)
+            on_durable = None
+        for table, key, values in changes:
+            self.pending[(table, key)] = values
+        if on_durable:
+            self.unsynced.append(on_durable)
+        self.unsynced_sets += 1
+        self.accepted += 1
+
+    def sync_journal(self):
+        if not self.unsynced_sets:
+            return
+        error = None
+        started = time.perf_counter()
+        try:
+            journal.sync()
+            metrics.observe("currencybot_journal_fsync_seconds", time.perf_counter() - started)
+        except OSError as e:
+            print(f"❌ Journal fsync failed: {e}")
+            error = e
+        for on_durable in self.unsynced:
+            on_durable(error)
+        self.unsynced.clear()
+        self.unsynced_sets = 0
+
+    def drain(self):
+        """Pull anything still queued into pending without waiting."""
+        while True:
+            try:
+                kind, payload = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if kind == "changes":
+                self.accept(*payload)
+            elif kind == "flush":
+                payload.set()
+
+    def write_pending(self, conn):
+        if not self.pending:
+            self.committed = self.accepted
+            return
+        started = time.perf_counter()
+        try:
+            with db.lock:
+                write_changes(conn, self.pending)
+        except sqlite3.Error as e:
+            # Keep the changes pending and retry on the next flush
+            print(f"❌ DB write failed: {e}")
+            return
+        metrics.observe("currencybot_flush_seconds", time.perf_counter() - started)
+        metrics.observe("currencybot_flush_rows", len(self.pending), bounds=ROW_BUCKETS)
+        metrics.inc("currencybot_rows_written_total", amount=len(self.pending))
+        self.pending.clear()
+        self.committed = self.accepted
+        # Once SQLite is checkpointed everything journaled so far is redundant
+        if db.checkpoint():
+            self.sync_journal()
+            journal.truncate()
+
+    def write_compact(self, conn, guild_ids, rows):
+        with db.lock, conn:
+            for table, table_rows in rows.items():
+                conn.executemany(f"DELETE FROM {table} WHERE guild_id=?", [(guild_id,) for guild_id in guild_ids])
+                conn.executemany(upsert_sql(table), table_rows)
+            bump_generation(conn)
+        if db.checkpoint(force=True):
+            journal.truncate()
+
+
+db_writer = DBWriter()
+
+
+def shutdown_db():
+    """Flush every pending change; safe to call more than once."""
+    save_db()
+    db_writer.stop()
+
+
+atexit.register(shutdown_db)
+
+
+# --- Cooldown Engine ---
+# Every command cooldown lives in `cooldowns`, keyed (guild, user, command), as the time the
+# command was last used; the guild's current setting turns that into a next-eligible time,
+# so /set_cooldown still applies to running timers. A min-heap of expiry times lets
+# purge_expired() drop finished timers, and their rows, without scanning every user.
+
+COOLDOWN_PURGE_INTERVAL = 60  # seconds
+
+
+class CooldownEngine:
+    def __init__(self):
+        self.heap = []  # (expires_at, guild_id, user_id, command, last_used)
+
+    def duration(self, guild_id, command):
+        return guild_cooldowns.get(guild_id, {}).get(command, COOLDOWN_SECONDS)
+
+    def ready_at(self, guild_id, user_id, command):
+        """When the user may run the command again, or None if there is no timer."""
+        last_used = cooldowns.get(guild_id, {}).get(user_id, {}).get(command)
+        if last_used is None:
+            return None
+        return last_used + self.duration(guild_id, command)
+
+    def remaining(self, guild_id, user_id, command, now=None):
+        """Seconds left on the timer, or 0 if the command is ready."""
+        ready_at = self.ready_at(guild_id, user_id, command)
+        if ready_at is None:
+            return 0
+        return max(0.0, ready_at - (time.time() if now is None else now))
+
+    def timers(self, guild_id, user_id, now=None):
+        """{ command: seconds remaining } for every cooldown command, in one lookup per command."""
+        return {command: self.remaining(guild_id, user_id, command, now) for command in COOLDOWN_COMMANDS}
+
+    def stamp(self, guild_id, user_id, command, now):
+        set_cooldown_stamp(command, guild_id, user_id, now)
+        heapq.heappush(self.heap, (now + self.duration(guild_id, command), guild_id, user_id, command, now))
+
+    def clear(self, guild_id, user_id, command):
+        set_cooldown_stamp(command, guild_id, user_id, None)
+
+    def schedule_guild(self, guild_id):
+        """Queue expiry for every timer of a guild that was just loaded."""
+        for user_id, user_timers in dict.get(cooldowns, guild_id, {}).items():
+            for command, last_used in user_timers.items():
+                heapq.heappush(self.heap, (last_used + self.duration(guild_id, command),
+                                           guild_id, user_id, command, last_used))
+
+    def purge_expired(self, now=None):
+        """Drop every timer that has run out; returns how many were removed."""
+        now = time.time() if now is None else now
+        purged = 0
+        while self.heap and self.heap[0][0] <= now:
+            _, guild_id, user_id, command, last_used = heapq.heappop(self.heap)
+            if guild_id not in loaded_guilds:
+                continue  # evicted; rescheduled when the guild is loaded again
+            if dict.get(cooldowns, guild_id, {}).get(user_id, {}).get(command) != last_used:
+                continue  # cleared or restamped since this entry was queued
+            ready_at = last_used + self.duration(guild_id, command)
+            if ready_at > now:
+                # The guild lengthened this cooldown after the stamp
+                heapq.heappush(self.heap, (ready_at, guild_id, user_id, command, last_used))
+                continue
+            self.clear(guild_id, user_id, command)
+            purged += 1
+        return purged
+
+
+cooldown_engine = CooldownEngine()
+
+
+async def cooldown_purge_loop():
+    while True:
+        await asyncio.sleep(COOLDOWN_PURGE_INTERVAL)
+        if cooldown_engine.purge_expired():
+            save_db()
+
+
+# --- Transactions ---
+# Commands that move currency between accounts run inside transaction(). It takes one
+# asyncio lock per (guild, account) in sorted order, so commands touching the same accounts
+# run one after another while unrelated users proceed in parallel. Balances are re-checked
+# under the locks and the deltas applied together; the locks drop as soon as the change set is
+# queued, and the command then waits for it to be durable. The writer keeps change sets in
+# queue order, so a later command's commit never lands before an earlier one's.
 
+JACKPOT_ACCOUNT = 0  # account id of a guild's jackpot pot, in every currency
+
+# (guild_id, account) -> asyncio.Lock, dropped once no command holds or waits on it
+account_locks = weakref.WeakValueDictionary()
+
+
+class TransactionError(Exception):
+    """A transaction could not be applied; none of its changes were made."""
+
+
+class InsufficientFunds(TransactionError):
+    def __init__(self, account, currency, balance, needed):
+        super().__init__(f"Account {account} has {balance} {currency}, needs {needed}.")
+        self.account = account
+        self.currency = currency
+        self.balance = balance
+        self.needed = needed
+
+
+class CooldownActive(TransactionError):
+    """The command's cooldown was stamped by another call while this one waited for its locks."""
+
+    def __init__(self, remaining):
+        super().__init__(f"Cooldown active for {remaining} more seconds.")
+        self.remaining = remaining
+
+
+def account_balance(guild_id, account, currency):
+    if account == JACKPOT_ACCOUNT:
+        return jackpots.get(guild_id, {}).get(currency, 0)
+    return currencies_data[guild_id][currency]["balances"].get(account, 0)
+
+
+class Transaction:
+    """Pending balance deltas for a set of locked accounts in one guild."""
+
+    def __init__(self, guild_id, accounts):
+        self.guild_id = guild_id
+        self.accounts = set(accounts)
+        self.deltas = {}  # (account, currency) -> delta
+        self.entries = []  # (from_account, to_account, currency, amount, reason) for the ledger
+
+    def check_currency(self, currency):
+        if currency not in currencies_data.get(self.guild_id, {}):
+            raise TransactionError(f"Currency `{currency}` does not exist.")
+
+    def balance(self, account, currency):
+        """The account's balance as it will be once this transaction applies."""
+        self.check_currency(currency)
+        return account_balance(self.guild_id, account, currency) + self.deltas.get((account, currency), 0)
+
+    def require(self, account, currency, amount):
+        balance = self.balance(account, currency)
+        if balance < amount:
+            raise InsufficientFunds(account, currency, balance, amount)
+
+    def add(self, account, currency, delta, reason=None):
+        """Change one balance; with a reason, it is recorded as currency created or destroyed by the bot."""
+        if account not in self.accounts:
+            raise RuntimeError(f"Account {account} is not locked by this transaction")
+        self.check_currency(currency)
+        self.deltas[(account, currency)] = self.deltas.get((account, currency), 0) + delta
+        if reason is not None:
+            if delta > 0:
+                self.entries.append((None, account, currency, delta, reason))
+            else:
+                self.entries.append((account, None, currency, -delta, reason))
+
+    def transfer(self, currency, from_account, to_account, amount, reason):
+        if amount <= 0:
+            raise TransactionError(f"Transfer amount must be positive, not {amount}.")
+        self.add(from_account, currency, -amount)
+        self.add(to_account, currency, amount)
+        self.entries.append((from_account, to_account, currency, amount, reason))
+
+    def apply(self):
+        """Validate every delta, then apply them all; raises before changing anything."""
+        new_balances = []
+        for (account, currency), delta in self.deltas.items():
+            self.check_currency(currency)
+            balance = account_balance(self.guild_id, account, currency)
+            if delta < 0 and balance + delta < 0:
+                raise InsufficientFunds(account, currency, balance, -delta)
+            new_balances.append((account, currency, balance + delta))
+        for account, currency, amount in new_balances:
+            if account == JACKPOT_ACCOUNT:
+                set_jackpot(self.guild_id, currency, amount)
+            else:
+                set_user_balance(self.guild_id, currency, account, amount)
+        for entry in self.entries:
+            ledger.record(self.guild_id, *entry)
+
+
+def account_lock(guild_id, account):
+    lock = account_locks.get((guild_id, account))
+    if lock is None:
+        lock = account_locks[(guild_id, account)] = asyncio.Lock()
+    return lock
+
+
+@contextlib.asynccontextmanager
+async def transaction(guild_id, *accounts):
+    """
+    Lock the given accounts and yield a Transaction. When the block exits normally its deltas
+    are validated and applied, the locks released, and the change committed; if anything
+    raises, nothing is changed.
+    """
+    locks = [account_lock(guild_id, account) for account in sorted(set(accounts))]
+    acquired = []
+    try:
+        for lock in locks:
+            await lock.acquire()
+            acquired.append(lock)
+        txn = Transaction(guild_id, accounts)
+        yield txn
+        txn.apply()
+        # Queue the change set while still holding the locks, but don't hold them through the fsync
+        durable = commit_db()
+    finally:
+        for lock in reversed(acquired):
+            lock.release()
+    await durable
+
+
+def settle_gamble(txn, user_id, currency, amount):
+    """Play one gamble; returns (won, jackpot_winnings) with jackpot_winnings as { currency: amount }."""
+    txn.require(user_id, currency, amount)
+    if random.random() >= 0.5:  # 50% chance
+        # Lost coins go into that currency's jackpot pool
+        txn.transfer(currency, user_id, JACKPOT_ACCOUNT, amount, "gamble")
+        return False, {}
+
+    txn.add(user_id, currency, amount, "gamble")
+    jackpot_winnings = {}
+    # 🎯 0.1% * bet jackpot chance
+    jackpot_chance = min(0.002 * amount, 0.5)  # e.g., 0.002 * 500 = 1.0 (100%)
+    if random.random() < jackpot_chance:
+        guild_currencies = currencies_data.get(txn.guild_id, {})
+        for cur_name in list(jackpots.get(txn.guild_id, {})):
+            if cur_name not in guild_currencies:
+                continue  # pot left behind by a currency removed before pots were cleaned up
+            pot_amount = txn.balance(JACKPOT_ACCOUNT, cur_name)
+            if pot_amount > 0:
+                txn.transfer(cur_name, JACKPOT_ACCOUNT, user_id, pot_amount, "jackpot")
+                jackpot_winnings[cur_name] = pot_amount
+    return True, jackpot_winnings
+
+
+def attempt_robbery(txn, robber_id, target_id, currency=None):
+    """
+    Rob a random currency the target holds (or only `currency`). Returns
+    (currency_name, success, amount) where amount is what was stolen or the penalty paid
+    into the jackpot, or None if the target has nothing to steal.
+    """
+    candidates = [currency] if currency else holdings.get(txn.guild_id, {}).get(target_id, ())
+    nonzero_currencies = [name for name in candidates if txn.balance(target_id, name) > 0]
+    if not nonzero_currencies:
+        return None
+
+    currency_name = random.choice(nonzero_currencies)
+    robber_balance = txn.balance(robber_id, currency_name)
+    victim_balance = txn.balance(target_id, currency_name)
+
+    amount = random.randint(1, min(50, victim_balance))  # cap at 50 or victim’s balance
+    if random.random() < 0.5:  # 50% chance to succeed
+        txn.transfer(currency_name, target_id, robber_id, amount, "rob")
+        return currency_name, True, amount
+
+    max_penalty = min(50, robber_balance)
+    penalty = random.randint(1, max_penalty) if max_penalty > 0 else 0
+    if penalty:
+        txn.transfer(currency_name, robber_id, JACKPOT_ACCOUNT, penalty, "rob_penalty")
+    return currency_name, False, penalty
+
+
+# --- Metrics ---
+# Fixed-bucket histograms and counters, cheap enough to update on every call (one bisect
+# and two adds), served in Prometheus text format on a local HTTP endpoint. Gauges are
+# computed only when scraped.
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108  # set to None to disable the endpoint
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+METRIC_HELP = {
+    "currencybot_command_seconds": ("histogram", "Time from interaction check to handler completion."),
+    "currencybot_commands_total": ("counter", "App commands handled, by outcome."),
+    "currencybot_command_errors_total": ("counter", "App command errors, by exception type."),
+    "currencybot_discord_request_seconds": ("histogram", "Discord HTTP API round trips, by route and status."),
+    "currencybot_load_db_seconds": ("histogram", "Time to open the database at startup."),
+    "currencybot_guild_load_seconds": ("histogram", "Time to load a guild's state on first access, by source."),
+    "currencybot_save_db_seconds": ("histogram", "Time for save_db() to collect dirty cells and queue them."),
+    "currencybot_commit_seconds": ("histogram", "Time a command waits for its changes to be journaled."),
+    "currencybot_journal_fsync_seconds": ("histogram", "Journal fsync duration."),
+    "currencybot_flush_seconds": ("histogram", "Duration of each SQLite write transaction."),
+    "currencybot_flush_rows": ("histogram", "Rows written per SQLite write transaction."),
+    "currencybot_rows_written_total": ("counter", "Rows upserted or deleted in SQLite."),
+    "currencybot_loaded_guilds": ("gauge", "Guilds whose state is in memory."),
+    "currencybot_guild_memory_bytes": ("gauge", "Bytes held by a loaded guild's balance arrays and indexes."),
+    "currencybot_dirty_cells": ("gauge", "Changed cells not yet handed to the writer."),
+    "currencybot_writer_queue": ("gauge", "Messages waiting for the writer thread."),
+    "currencybot_writer_pending_rows": ("gauge", "Rows coalesced in the writer, not yet in SQLite."),
+    "currencybot_loop_lag_seconds": ("histogram", "How late the event loop ran the heartbeat task."),
+    "currencybot_loop_stalls_total": ("counter", "Times the event loop was blocked past the stall threshold, by command."),
+    "currencybot_loop_lag_max_seconds": ("gauge", "Longest event loop lag seen since startup."),
+    "currencybot_render_cache_total": ("counter", "Embed body lookups in the render cache, by view and result."),
+    "currencybot_display_name_lookups_total": ("counter", "Leaderboard name lookups, by cache result."),
+    "currencybot_display_name_cache_entries": ("gauge", "Display names held in the bounded name cache."),
+    "currencybot_view_registry_entries": ("gauge", "Pending interactive views (trades) held in the view registry."),
+}
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+def format_labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = []  # callables returning [(name, labels, value), ...] at scrape time
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=(), bounds=LATENCY_BUCKETS):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram(bounds)
+        histogram.observe(value)
+
+    def render(self):
+        """Everything in Prometheus text exposition format."""
+        series = {}  # name -> [lines]
+        for (name, labels), value in list(self.counters.items()):
+            series.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in list(self.histograms.items()):
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + (float("inf"),), list(histogram.counts)):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{format_labels(labels, (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        for gauge in self.gauges:
+            for name, labels, value in gauge():
+                series.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+
+        out = []
+        for name, lines in series.items():
+            kind, text = METRIC_HELP.get(name, ("untyped", ""))
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+
+
+def state_gauges():
+    yield "currencybot_loaded_guilds", (), len(loaded_guilds)
+    for guild_id in list(loaded_guilds):
+        usage = sum(data["balances"].memory_usage() for data in dict.get(currencies_data, guild_id, {}).values())
+        yield "currencybot_guild_memory_bytes", (("guild", guild_id),), usage
+    yield "currencybot_dirty_cells", (), len(dirty_cells)
+    yield "currencybot_writer_queue", (), db_writer.queue.qsize()
+    yield "currencybot_writer_pending_rows", (), len(db_writer.pending)
+
+
+metrics.gauges.append(state_gauges)
+
+
+def record_command(interaction, status, error=None):
+    command = interaction.command.qualified_name if interaction.command else "unknown"
+    started = interaction.extras.get("started")
+    if started is not None:
+        metrics.observe("currencybot_command_seconds", time.perf_counter() - started, (("command", command),))
+    metrics.inc("currencybot_commands_total", (("command", command), ("status", status)))
+    if error is not None:
+        error_type = type(getattr(error, "original", error)).__name__
+        metrics.inc("currencybot_command_errors_total", (("command", command), ("error", error_type)))
+
+
+class MetricsTree(app_commands.CommandTree):
+    """Command tree that times every app command; completion is recorded in on_app_command_completion."""
+
+    async def interaction_check(self, interaction):
+        interaction.extras["started"] = time.perf_counter()
+        await load_guild(interaction.guild_id)
+        return True
+
+    async def on_error(self, interaction, error):
+        record_command(interaction, "error", error)
+        await super().on_error(interaction, error)
+
+
+def discord_route(path):
+    """Collapse ids and tokens out of a Discord API path so routes can be used as labels."""
+    path = re.sub(r"^/api/v\d+", "", path)
+    path = re.sub(r"/\d{15,}", "/:id", path)
+    return re.sub(r"(/(?:interactions|webhooks)/:id)/[^/]+", r"\1/:token", path)
+
+
+def discord_http_trace():
+    """aiohttp trace hooks that time every Discord API request."""
+    trace = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params):
+        context.started = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        labels = (("method", params.method), ("route", discord_route(params.url.path)),
+                  ("status", params.response.status))
+        metrics.observe("currencybot_discord_request_seconds", time.perf_counter() - context.started, labels)
+
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+
+async def start_metrics_server():
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+        print(f"📈 Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        print(f"❌ Metrics endpoint failed to start: {e}")
+
+
+# --- Event Loop Watchdog ---
+# A heartbeat task measures how late the loop wakes it up. A watchdog thread notices when
+# the heartbeat is overdue, which means something is blocking the loop right now, and logs
+# the loop thread's stack together with the command and guild of the interaction being handled.
+
+LOOP_LAG_INTERVAL = 0.1  # seconds between heartbeats
+LOOP_STALL_THRESHOLD = 0.25  # seconds overdue before the stack is reported
+LOOP_STALL_STACK_DEPTH = 20  # innermost frames to log
+
+
+def running_interaction(frame):
+    """Walk outward from `frame` to the nearest frame holding an `interaction`; return (command, guild_id)."""
+    while frame is not None:
+        interaction = frame.f_locals.get("interaction")
+        if interaction is not None and hasattr(interaction, "guild_id"):
+            command = getattr(interaction, "command", None)
+            return (command.qualified_name if command else "component"), interaction.guild_id
+        frame = frame.f_back
+    return "none", None
+
+
+class LoopWatchdog:
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=LOOP_STALL_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.loop_thread = None
+        self.last_beat = time.monotonic()
+        self.max_lag = 0.0
+        self.stalls = 0
+
+    async def heartbeat(self):
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        threading.Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - self.last_beat - self.interval)
+            self.last_beat = now
+            self.max_lag = max(self.max_lag, lag)
+            metrics.observe("currencybot_loop_lag_seconds", lag)
+
+    def watch(self):
+        reported_beat = None
+        while True:
+            time.sleep(self.interval / 2)
+            beat = self.last_beat
+            overdue = time.monotonic() - beat - self.interval
+            if overdue > self.threshold and beat != reported_beat:
+                reported_beat = beat  # one report per stall
+                self.report(overdue)
+
+    def report(self, overdue):
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is None:
+            return
+        command, guild_id = running_interaction(frame)
+        self.stalls += 1
+        metrics.inc("currencybot_loop_stalls_total", (("command", command),))
+        frames = traceback.extract_stack(frame)
+        # Drop the event loop's own frames so the stack starts at the task that is blocking
+        task_start = max((i + 1 for i, entry in enumerate(frames) if entry.filename.endswith(os.path.join("asyncio", "events.py"))), default=0)
+        stack = "".join(traceback.format_list(frames[task_start:][-LOOP_STALL_STACK_DEPTH:]))
+        print(f"⚠️ Event loop blocked for {overdue * 1000:.0f} ms so far, in /{command} (guild {guild_id}):\n{stack}")
+
+
+loop_watchdog = LoopWatchdog()
+metrics.gauges.append(lambda: [("currencybot_loop_lag_max_seconds", (), loop_watchdog.max_lag)])
+
+
+# --- Display Names ---
+# With CACHE_ALL_MEMBERS off, discord.py keeps no Member objects at all (the largest use of
+# memory on big servers). Embeds that list other users resolve names through a bounded LRU
+# instead, filled by one batched gateway member query per page of misses.
+
+CACHE_ALL_MEMBERS = False
+DISPLAY_NAME_CACHE_SIZE = 20_000
+DISPLAY_NAME_TTL = 60 * 60  # seconds before a cached name is looked up again
+DISPLAY_NAME_FETCH_TIMEOUT = 1.5  # seconds; interactions must be answered within 3
+MEMBER_QUERY_LIMIT = 100  # user ids Discord accepts per member query
+
+
+class DisplayNameCache:
+    def __init__(self, capacity=DISPLAY_NAME_CACHE_SIZE, ttl=DISPLAY_NAME_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.names = OrderedDict()  # (guild_id, user_id) -> (display name, or None if not a member, expires_at)
+
+    def remember(self, guild_id, user_id, name):
+        key = (guild_id, user_id)
+        self.names[key] = (name, time.monotonic() + self.ttl)
+        self.names.move_to_end(key)
+        while len(self.names) > self.capacity:
+            self.names.popitem(last=False)
+
+    def lookup(self, guild_id, user_id):
+        """(found, name); name is None for users known to have left the guild."""
+        key = (guild_id, user_id)
+        entry = self.names.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            return False, None
+        self.names.move_to_end(key)
+        return True, entry[0]
+
+    async def resolve(self, guild, user_ids):
+        """{ user_id: display name or None } for every id, fetching uncached ones from Discord."""
+        names = {}
+        missing = []
+        for user_id in user_ids:
+            found, name = self.lookup(guild.id, user_id)
+            if not found:
+                member = guild.get_member(user_id)  # still answers when the member cache is on
+                if member is not None:
+                    found, name = True, member.display_name
+                    self.remember(guild.id, user_id, name)
+            if found:
+                names[user_id] = name
+            else:
+                missing.append(user_id)
+        metrics.inc("currencybot_display_name_lookups_total", (("result", "hit"),), len(names))
+        metrics.inc("currencybot_display_name_lookups_total", (("result", "miss"),), len(missing))
+
+        for start in range(0, len(missing), MEMBER_QUERY_LIMIT):
+            batch = missing[start:start + MEMBER_QUERY_LIMIT]
+            try:
+                members = await asyncio.wait_for(
+                    guild.query_members(user_ids=batch, limit=len(batch), cache=CACHE_ALL_MEMBERS),
+                    DISPLAY_NAME_FETCH_TIMEOUT,
+                )
+            except (asyncio.TimeoutError, discord.ClientException, discord.HTTPException) as e:
+                # Not cached, so the next page view tries again
+                print(f"❌ Member lookup failed in guild {guild.id}: {e!r}")
+                continue
+            fetched = {member.id: member.display_name for member in members}
+            for user_id in batch:
+                names[user_id] = fetched.get(user_id)
+                self.remember(guild.id, user_id, names[user_id])
+        return names
+
+
+display_names = DisplayNameCache()
+metrics.gauges.append(lambda: [("currencybot_display_name_cache_entries", (), len(display_names.names))])
+
+
+# --- Persistent Views ---
+# Buttons and selects are discord.ui.DynamicItems whose state is encoded in their custom_id.
+# discord.py rebuilds the item from the id each time a component is used, so no View object
+# is kept per message, and messages keep working across restarts. State too large for the
+# 100-character id (a trade's terms and confirmations) lives in a bounded registry instead.
+
+VIEW_REGISTRY_SIZE = 1000  # live entries kept before the least recently used is dropped
+
+
+def name_tag(name):
+    """Short fixed-length stand-in for a currency name inside a custom_id."""
+    return f"{zlib.crc32(name.encode()):08x}"
+
+
+def currency_by_tag(guild_id, tag):
+    """
+    The guild's currency whose name_tag() is `tag`, or None if it was removed or renamed, or
+    if several share it (possible only for currencies named before tag_collision() was checked).
+    """
+    matches = [name for name in currencies_data.get(guild_id, {}) if name_tag(name) == tag]
+    return matches[0] if len(matches) == 1 else None
+
+
+def tag_collision(guild_id, name, ignore=None):
+    """Another of the guild's currencies (besides `ignore`) with the same name_tag() as `name`, or None."""
+    tag = name_tag(name)
+    return next((other for other in currencies_data.get(guild_id, {})
+                 if other not in (name, ignore) and name_tag(other) == tag), None)
+
+
+class ViewRegistry:
+    """Bounded LRU of { key: state } for views whose state doesn't fit in a custom_id; entries expire."""
+
+    def __init__(self, capacity=VIEW_REGISTRY_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # key -> (expires_at, state)
+
+    def add(self, state, ttl):
+        """Store `state` for `ttl` seconds and return its key, for use in custom ids."""
+        key = f"{random.getrandbits(48):012x}"
+        while key in self.entries:
+            key = f"{random.getrandbits(48):012x}"
+        self.entries[key] = (time.monotonic() + ttl, state)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return key
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def pop(self, key):
+        self.entries.pop(key, None)
+
+
+view_registry = ViewRegistry()
+metrics.gauges.append(lambda: [("currencybot_view_registry_entries", (), len(view_registry.entries))])
 
 
 # --- Bot Setup ---
@@ -263,10 +2442,13 @@ ssl._create_default_https_context = lambda: ssl_context
 
 # --- Now import and run your bot ---
 intents = discord.Intents.default()
-intents.members = True
-bot = commands.Bot(command_prefix="!", intents=intents)
-
-load_db()
+intents.members = True  # still needed to query members on demand
+if CACHE_ALL_MEMBERS:
+    member_cache = {}
+else:
+    member_cache = {"member_cache_flags": discord.MemberCacheFlags.none(), "chunk_guilds_at_startup": False}
+bot = commands.Bot(command_prefix="!", intents=intents, tree_cls=MetricsTree, http_trace=discord_http_trace(),
+                   **member_cache)
 
 
 @bot.tree.command(name="set_cooldown", description="Set cooldown for homework, office hours, or rob for this server.")
@@ -277,22 +2459,16 @@ load_db()
     app_commands.Choice(name="rob", value="rob")
 ])
 @app_commands.checks.has_permissions(manage_guild=True)
+@app_commands.default_permissions(manage_guild=True)
 async def set_cooldown(interaction: discord.Interaction, command: app_commands.Choice[str], seconds: int):
     guild_id = interaction.guild.id
     if seconds < 0:
         await interaction.response.send_message("❌ Cooldown must be 0 or greater.", ephemeral=True)
         return
 
-    # Initialize defaults if missing
-    guild_cooldowns.setdefault(guild_id, {
-        "homework": COOLDOWN_SECONDS,
-        "officehours": COOLDOWN_SECONDS,
-        "rob": COOLDOWN_SECONDS  # Default 6 hours
-    })
-
     # Set new cooldown
-    guild_cooldowns[guild_id][command.value] = seconds
-    save_guild_cooldowns()
+    set_guild_cooldown(guild_id, command.value, seconds)
+    await commit_db()
 
     await interaction.response.send_message(
         f"✅ `{command.value}` cooldown set to **{seconds} seconds** for this server."
@@ -322,6 +2498,7 @@ def parse_emoji(emoji_str):
     emoji="Emoji to represent the currency"
 )
 @app_commands.checks.has_permissions(manage_guild=True)
+@app_commands.default_permissions(manage_guild=True)
 async def add_currency(interaction: discord.Interaction, name: str, emoji: str):
     guild_id = interaction.guild.id
     guild_currencies = currencies_data.setdefault(guild_id, {})
@@ -332,14 +2509,19 @@ async def add_currency(interaction: discord.Interaction, name: str, emoji: str):
             description=f"❌ Currency `{name}` already exists!",
             color=discord.Color.red()
         )
-        embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-        embed.timestamp = datetime.now()
+        add_footer(embed, interaction.user)
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
+    # Buttons refer to currencies by name_tag(), so two currencies must never share one
+    clash = tag_collision(guild_id, name)
+    if clash is not None:
+        await interaction.response.send_message(
+            f"❌ `{name}` can't be told apart from `{clash}` in buttons. Please pick another name.",
+            ephemeral=True
+        )
+        return
+
     # Save currency with emoji
     emoji_parsed = parse_emoji(emoji)
     if not emoji_parsed:
@@ -350,8 +2532,8 @@ async def add_currency(interaction: discord.Interaction, name: str, emoji: str):
         return
 
     # Save currency with emoji
-    guild_currencies[name] = {"emoji": emoji_parsed, "balances": {}}
-    save_db()
+    add_guild_currency(guild_id, name, emoji_parsed)
+    await commit_db()
 
 
     embed = discord.Embed(
@@ -359,27 +2541,24 @@ async def add_currency(interaction: discord.Interaction, name: str, emoji: str):
         description=f"✅ {interaction.user.mention} added the currency **{name}** with emoji {emoji} to this server!",
         color=discord.Color.green()
     )
-    embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-    embed.timestamp = datetime.now()
+    add_footer(embed, interaction.user)
     await interaction.response.send_message(embed=embed)
 
 # --- Autocomplete function ---
 async def currency_autocomplete(interaction: discord.Interaction, current: str):
-    guild_id = interaction.guild.id
-    guild_currencies = currencies_data.get(guild_id, {})
+    index = currency_index.get(interaction.guild.id)
+    if index is None:
+        return []
     return [
         app_commands.Choice(name=name, value=name)
-        for name in guild_currencies.keys()
-        if current.lower() in name.lower()
-    ][:25]  # Discord allows max 25 choices
+        for name in index.search(current, 25)  # Discord allows max 25 choices
+    ]
 
 @bot.tree.command(name="set_balance", description="Set a user's balance for a currency.")
 @app_commands.describe(currency="Currency name", user="User to set balance for", amount="Balance amount")
 @app_commands.autocomplete(currency=currency_autocomplete)  # attach autocomplete
 @app_commands.checks.has_permissions(manage_guild=True)
+@app_commands.default_permissions(manage_guild=True)
 async def set_balance(interaction: discord.Interaction, currency: str, user: discord.User, amount: int):
     guild_id = interaction.guild.id
     guild_currencies = currencies_data.get(guild_id, {})
@@ -388,8 +2567,13 @@ async def set_balance(interaction: discord.Interaction, currency: str, user: dis
         await interaction.response.send_message(f"❌ Currency `{currency}` not found!", ephemeral=True)
         return
 
-    guild_currencies[currency]["balances"][user.id] = amount
-    save_db()
+    old_amount = guild_currencies[currency]["balances"].get(user.id, 0)
+    set_user_balance(guild_id, currency, user.id, amount)
+    if amount > old_amount:
+        ledger.record(guild_id, None, user.id, currency, amount - old_amount, "set_balance")
+    elif amount < old_amount:
+        ledger.record(guild_id, user.id, None, currency, old_amount - amount, "set_balance")
+    await commit_db()
     await interaction.response.send_message(f"✅ Set {user.mention}'s `{currency}` balance to `{amount}`.")
 
 @set_balance.error
@@ -400,11 +2584,7 @@ async def set_balance_error(interaction: discord.Interaction, error):
             description="❌ You do not have permission to use this command.",
             color=discord.Color.red()
         )
-        embed.set_footer(
-        text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-        icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-        )
-        embed.timestamp = datetime.now()
+        add_footer(embed, interaction.user)
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
 async def get_currency_choices(interaction: discord.Interaction):
@@ -429,32 +2609,28 @@ async def balance(interaction: discord.Interaction, user: discord.User = None):
             description="❌ This guild has no currencies yet.",
             color=discord.Color.red()
         )
-        embed.set_footer(
-        text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-        icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-        )
-        embed.timestamp = datetime.now()
+        add_footer(embed, interaction.user)
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
-    # Build balance description
-    description = ""
-    for currency_name, data in guild_currencies.items():
-        emoji = data.get("emoji", "")
-        amount = data.get("balances", {}).get(user.id, 0)
-        description += f"{emoji} **{currency_name}:** {amount}\n"
+    # Build balance description from the currencies the user actually holds
+    def build():
+        description = ""
+        for currency_name in held_currencies(guild_id, user.id):
+            data = guild_currencies[currency_name]
+            emoji = data.get("emoji", "")
+            amount = data["balances"].get(user.id, 0)
+            description += f"{emoji} **{currency_name}:** {amount}\n"
+        return description or "No balances yet."
 
+    description = cached_render(guild_id, ("balance", user.id), ("currencies", ("user", user.id)), build)
 
     embed = discord.Embed(
         title=f"{user.display_name}'s Balances",
         description=description,
         color=discord.Color.blue()
     )
-    embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-    embed.timestamp = datetime.now()
+    add_footer(embed, interaction.user)
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="list_currencies", description="List all currencies in this guild.")
@@ -468,30 +2644,26 @@ async def list_currencies(interaction: discord.Interaction):
             description="❌ This guild has no currencies yet.",
             color=discord.Color.red()
         )
-        embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-        embed.timestamp = datetime.now()
+        add_footer(embed, interaction.user)
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
     # Build currency list with emojis
-    description = ""
-    for name, data in guild_currencies.items():
-        emoji = data.get("emoji", "")
-        description += f"{emoji} **{name}**\n"
+    def build():
+        description = ""
+        for name, data in guild_currencies.items():
+            emoji = data.get("emoji", "")
+            description += f"{emoji} **{name}**\n"
+        return description
+
+    description = cached_render(guild_id, ("list_currencies",), ("currencies",), build)
 
     embed = discord.Embed(
         title="💱 Available Currencies",
         description=description,
         color=discord.Color.blue()
     )
-    embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-    embed.timestamp = datetime.now()
+    add_footer(embed, interaction.user)
 
     await interaction.response.send_message(embed=embed)
 
@@ -512,30 +2684,20 @@ async def homework(interaction: discord.Interaction):
             description="❌ No currencies available in this guild.",
             color=discord.Color.red()
         )
-        embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-        embed.timestamp = datetime.now()
+        add_footer(embed, interaction.user)
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
     # Check cooldown
-    cd = guild_cooldowns.get(guild_id, {}).get("homework", COOLDOWN_SECONDS)
-    last_time = hw_cooldowns.get(guild_id, {}).get(user_id, 0)
     now = time.time()
-    if now - last_time < cd:
-        remaining = cd - (now - last_time)
+    remaining = cooldown_engine.remaining(guild_id, user_id, "homework", now)
+    if remaining > 0:
         embed = discord.Embed(
             title="Cooldown Active",
             description=f"⏱ You must wait {timedelta(seconds=int(remaining))} before doing homework again.",
             color=discord.Color.orange()
         )
-        embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-        embed.timestamp = datetime.now()
+        add_footer(embed, interaction.user)
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
@@ -545,16 +2707,13 @@ async def homework(interaction: discord.Interaction):
     amount = random.randint(1, 10)
 
     # Update balance
-    user_balances = guild_currencies[currency_name]["balances"]
-    
-    user_balances[user_id] = user_balances.get(user_id, 0) + amount
-
-   
+    add_user_balance(guild_id, currency_name, user_id, amount)
+    ledger.record(guild_id, None, user_id, currency_name, amount, "homework")
 
     # Update cooldown
-    hw_cooldowns.setdefault(guild_id, {})[user_id] = now
+    cooldown_engine.stamp(guild_id, user_id, "homework", now)
 
-    save_db()
+    await commit_db()
 
     emoji = currency_data.get("emoji", "💰")
 
@@ -564,12 +2723,7 @@ async def homework(interaction: discord.Interaction):
         color=discord.Color.green()
     )
     #embed.set_footer(text=f"Requested by {interaction.user}", icon_url=interaction.user.avatar.url if interaction.user.avatar else None)
-    embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-
-    embed.timestamp = datetime.now()
+    add_footer(embed, interaction.user)
     await interaction.response.send_message(embed=embed)
 
 
@@ -585,21 +2739,15 @@ async def officehours(interaction: discord.Interaction):
         return
 
     # Check cooldown
-    cd = guild_cooldowns.get(guild_id, {}).get("officehours", COOLDOWN_SECONDS)
-    last_time = office_cooldowns.get(guild_id, {}).get(user_id, 0)
     now = time.time()
-    if now - last_time < cd:
-        remaining = cd - (now - last_time)
+    remaining = cooldown_engine.remaining(guild_id, user_id, "officehours", now)
+    if remaining > 0:
         embed = discord.Embed(
             title="Cooldown Active",
             description=f"⏱ You must wait {timedelta(seconds=int(remaining))} before attending office hours again.",
             color=discord.Color.orange()
         )
-        embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-        embed.timestamp = datetime.now()
+        add_footer(embed, interaction.user)
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
@@ -608,37 +2756,133 @@ async def officehours(interaction: discord.Interaction):
     amount = random.randint(1, 10)
 
     # Update balance
-    user_balances = guild_currencies[currency]["balances"]
-    user_balances[user_id] = user_balances.get(user_id, 0) + amount
-    
+    add_user_balance(guild_id, currency, user_id, amount)
+    ledger.record(guild_id, None, user_id, currency, amount, "officehours")
 
     # Update cooldown
-    office_cooldowns.setdefault(guild_id, {})[user_id] = now
+    cooldown_engine.stamp(guild_id, user_id, "officehours", now)
 
-    save_db()
+    await commit_db()
 
     embed = discord.Embed(
         title="Office Hours Attended!",
         description=f"🎓 {interaction.user.mention} attended office hours and earned **{amount} {currency}**!",
         color=discord.Color.green()
     )
-    embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-    embed.timestamp = datetime.now()
+    add_footer(embed, interaction.user)
     await interaction.response.send_message(embed=embed)
 
 
-from discord.ui import View, Button
-from datetime import datetime
-import discord
-from discord import app_commands
+# --- /cooldowns command ---
+@bot.tree.command(name="cooldowns", description="Show when you can use each cooldown command again.")
+async def cooldowns_command(interaction: discord.Interaction):
+    guild_id = interaction.guild.id
+    timers = cooldown_engine.timers(guild_id, interaction.user.id)
+
+    embed = discord.Embed(title="⏱ Your Cooldowns", color=discord.Color.blue())
+    for command, remaining in timers.items():
+        value = f"⏱ {timedelta(seconds=int(remaining))} remaining" if remaining > 0 else "✅ Ready"
+        embed.add_field(name=f"/{command}", value=value, inline=False)
+
+    add_footer(embed, interaction.user)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+from discord.ui import View, Button
+from datetime import datetime
+import discord
+from discord import app_commands
+
+# --- Slash command: remove_currency ---
+REMOVE_CONFIRM_SECONDS = 30
+
+
+class GuildComponent:
+    """Mixin for persistent components: load the guild off the event loop before the callback runs."""
+
+    async def interaction_check(self, interaction):
+        await load_guild(interaction.guild_id)
+        return True
+
+
+class ConfirmRemoveButton(GuildComponent, discord.ui.DynamicItem[Button],
+                          template=r"cb:rm:(?P<action>confirm|cancel):(?P<owner>\d+):(?P<tag>[0-9a-f]{8}):(?P<expires>\d+)"):
+    """Confirm / Cancel on a /remove_currency prompt: who may press it, which currency, and until when."""
+
+    def __init__(self, action, owner_id, tag, expires):
+        if action == "confirm":
+            label, style = "Confirm", discord.ButtonStyle.danger
+        else:
+            label, style = "Cancel", discord.ButtonStyle.secondary
+        super().__init__(Button(label=label, style=style, custom_id=f"cb:rm:{action}:{owner_id}:{tag}:{expires}"))
+        self.action = action
+        self.owner_id = owner_id
+        self.tag = tag
+        self.expires = expires
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["action"], int(match["owner"]), match["tag"], int(match["expires"]))
+
+    async def callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.owner_id:
+            await interaction.response.send_message(f"❌ You cannot {self.action} this.", ephemeral=True)
+            return
+
+        guild_id = interaction.guild.id
+        name = currency_by_tag(guild_id, self.tag)
+        if name is None:
+            await interaction.response.send_message("❌ That currency no longer exists.", ephemeral=True)
+            return
+        if time.time() > self.expires:
+            embed = discord.Embed(
+                title="⌛ Removal Expired",
+                description="This confirmation is no longer valid. Run `/remove_currency` again.",
+                color=discord.Color.red()
+            )
+            add_footer(embed, interaction.user)
+            await interaction.response.edit_message(embed=embed, view=None)
+            return
+
+        if self.action == "cancel":
+            embed = discord.Embed(
+                title="❌ Removal Cancelled",
+                description=f"Currency `{name}` was not removed.",
+                color=discord.Color.red()
+            )
+            add_footer(embed, interaction.user)
+
+            await interaction.response.edit_message(embed=embed, view=None)
+            return
+
+        # Remove currency
+        remove_guild_currency(guild_id, name)
+        await commit_db()
+
+        embed = discord.Embed(
+            title=f"🗑️ Currency Removed",
+            description=f"✅ {interaction.user.mention} removed the currency **{name}** from this server.",
+            color=discord.Color.orange()
+        )
+        add_footer(embed, interaction.user)
+
+        await interaction.response.edit_message(embed=embed, view=None)
+
+
+class ConfirmRemoveView(View):
+    def __init__(self, owner_id, name):
+        super().__init__(timeout=None)
+        expires = int(time.time()) + REMOVE_CONFIRM_SECONDS
+        self.confirm = ConfirmRemoveButton("confirm", owner_id, name_tag(name), expires)
+        self.cancel = ConfirmRemoveButton("cancel", owner_id, name_tag(name), expires)
+        self.add_item(self.confirm)
+        self.add_item(self.cancel)
+
 
-# --- Slash command: remove_currency ---
 @bot.tree.command(name="remove_currency", description="Remove a currency from this guild.")
 @app_commands.describe(name="Name of the currency to remove")
 @app_commands.checks.has_permissions(manage_guild=True)
+@app_commands.default_permissions(manage_guild=True)
 @app_commands.autocomplete(name=currency_autocomplete)  # attach autocomplete
 async def remove_currency(interaction: discord.Interaction, name: str):
     guild_id = interaction.guild.id
@@ -650,79 +2894,19 @@ async def remove_currency(interaction: discord.Interaction, name: str):
             description=f"Currency `{name}` does not exist in this server.",
             color=discord.Color.red()
         )
-        embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-        embed.timestamp = datetime.now()
+        add_footer(embed, interaction.user)
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
-    # --- Confirmation Buttons ---
-    class ConfirmRemove(View):
-        def __init__(self, command_interaction: discord.Interaction):
-            super().__init__(timeout=30)
-            self.command_interaction = command_interaction  # original /remove_currency call
-
-        @discord.ui.button(label="Confirm", style=discord.ButtonStyle.danger)
-        async def confirm(self, interaction: discord.Interaction, button: Button):
-
-            if interaction.user.id != self.command_interaction.user.id:
-                await interaction.response.send_message("❌ You cannot confirm this.", ephemeral=True)
-                return
-
-            # Remove currency
-            guild_id = self.command_interaction.guild.id
-            guild_currencies = currencies_data.get(guild_id, {})
-            del guild_currencies[name]
-            save_db()
-
-            embed = discord.Embed(
-                title=f"🗑️ Currency Removed",
-                description=f"✅ {self.command_interaction.user.mention} removed the currency **{name}** from this server.",
-                color=discord.Color.orange()
-            )
-            embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-            embed.timestamp = datetime.now()
-
-            await interaction.response.edit_message(embed=embed, view=None)
-
-        @discord.ui.button(label="Cancel", style=discord.ButtonStyle.secondary)
-        async def cancel(self, interaction: discord.Interaction, button: Button):
-
-            if interaction.user.id != self.command_interaction.user.id:
-                await interaction.response.send_message("❌ You cannot cancel this.", ephemeral=True)
-                return
-
-            embed = discord.Embed(
-                title="❌ Removal Cancelled",
-                description=f"Currency `{name}` was not removed.",
-                color=discord.Color.red()
-            )
-            embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-            embed.timestamp = datetime.now()
-
-            await interaction.response.edit_message(embed=embed, view=None)
-
     # Send confirmation embed
     embed = discord.Embed(
         title="⚠️ Confirm Currency Removal",
         description=f"Are you sure you want to remove the currency **{name}**?\nThis action **cannot be undone**.",
         color=discord.Color.yellow()
     )
-    embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-    embed.timestamp = datetime.now()
+    add_footer(embed, interaction.user)
 
-    await interaction.response.send_message(embed=embed, view=ConfirmRemove(interaction))
+    await interaction.response.send_message(embed=embed, view=ConfirmRemoveView(interaction.user.id, name))
 
 @bot.tree.command(name="give", description="Give a certain amount of a currency to another user.")
 @app_commands.describe(
@@ -747,18 +2931,16 @@ async def give(interaction: discord.Interaction, currency: str, user: discord.Us
         await interaction.response.send_message(f"❌ Currency `{currency}` not found!", ephemeral=True)
         return
 
-    sender_balances = guild_currencies[currency]["balances"]
-    receiver_balances = guild_currencies[currency]["balances"]
-
-    sender_amount = sender_balances.get(interaction.user.id, 0)
-    if sender_amount < amount:
-        await interaction.response.send_message(f"❌ You only have {sender_amount} {currency}.", ephemeral=True)
-        return
-
     # Transfer
-    sender_balances[interaction.user.id] = sender_amount - amount
-    receiver_balances[user.id] = receiver_balances.get(user.id, 0) + amount
-    save_db()
+    try:
+        async with transaction(guild_id, interaction.user.id, user.id) as txn:
+            txn.transfer(currency, interaction.user.id, user.id, amount, "give")
+    except InsufficientFunds as e:
+        await interaction.response.send_message(f"❌ You only have {e.balance} {currency}.", ephemeral=True)
+        return
+    except TransactionError as e:
+        await interaction.response.send_message(f"❌ {e}", ephemeral=True)
+        return
 
     emoji = guild_currencies[currency].get("emoji", "")
 
@@ -767,11 +2949,7 @@ async def give(interaction: discord.Interaction, currency: str, user: discord.Us
         description=f"✅ {interaction.user.mention} gave **{amount} {currency}** to {user.mention}.",
         color=discord.Color.green()
     )
-    embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-    embed.timestamp = datetime.now()
+    add_footer(embed, interaction.user)
     await interaction.response.send_message(embed=embed)
 
 from discord import ui, Interaction, Embed, SelectOption
@@ -782,6 +2960,132 @@ from discord import ui, Interaction, Embed, SelectOption
 from datetime import datetime
 
 # --- /leaderboard command with dropdown ---
+LEADERBOARD_PAGE_SIZE = 10
+
+
+def leaderboard_pages(balances):
+    return max(1, -(-balances.holders() // LEADERBOARD_PAGE_SIZE))
+
+
+async def make_leaderboard_embed(guild, requester, currency_name, page=0):
+    """One page of a currency's leaderboard."""
+    guild_currencies = currencies_data.get(guild.id, {})
+    balances = guild_currencies[currency_name]["balances"]
+    view = ("leaderboard", currency_name, page)
+    topics = ("currencies", ("balances", currency_name))
+    rows, stamps = render_cache.lookup(guild.id, view, topics)
+    if rows is None:
+        # Only this page's rows are fetched from the rank index
+        page_users = tuple(balances.page(page * LEADERBOARD_PAGE_SIZE, LEADERBOARD_PAGE_SIZE))
+        rows = render_cache.store(guild.id, view, topics, stamps, (page_users, leaderboard_pages(balances)))
+    page_users, pages = rows
+    if not page_users:
+        desc = f"❌ No one has any `{currency_name}` yet."
+    else:
+        # Names stay out of the cached rows and go through the name cache on every render,
+        # so a renamed member shows up without waiting for a balance change
+        desc = ""
+        names = await display_names.resolve(guild, [user_id for user_id, _ in page_users])
+        for i, (user_id, amount) in enumerate(page_users, start=page * LEADERBOARD_PAGE_SIZE + 1):
+            username = names.get(user_id) or f"<Unknown User {user_id}>"
+            desc += f"**{i}. {username}** — {amount}\n"
+        desc += f"\nPage {page + 1}/{pages}"
+
+    emoji = guild_currencies[currency_name].get("emoji", "")
+    embed = Embed(
+        title=f"🏆 Leaderboard: {emoji} {currency_name}",
+        description=desc,
+        color=discord.Color.gold()
+    )
+    add_footer(embed, requester)
+    return embed
+
+
+class LeaderboardSelect(GuildComponent, ui.DynamicItem[ui.Select], template=r"cb:lb:pick"):
+    def __init__(self, options):
+        super().__init__(ui.Select(
+            placeholder="Select a currency...",
+            options=options,
+            min_values=1,
+            max_values=1,
+            custom_id="cb:lb:pick",
+            row=0
+        ))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(item.options)
+
+    async def callback(self, interaction: Interaction):
+        currency = self.item.values[0]
+        if currency not in currencies_data.get(interaction.guild.id, {}):
+            await interaction.response.send_message(f"❌ Currency `{currency}` no longer exists.", ephemeral=True)
+            return
+        await show_leaderboard_page(interaction, currency, 0)
+
+
+class LeaderboardButton(GuildComponent, ui.DynamicItem[ui.Button], template=r"cb:lb:(?P<action>prev|next|me):(?P<tag>[0-9a-f]{8}):(?P<page>\d+)"):
+    LABELS = {
+        "prev": ("◀ Prev", discord.ButtonStyle.secondary),
+        "next": ("Next ▶", discord.ButtonStyle.secondary),
+        "me": ("Jump to me", discord.ButtonStyle.primary),
+    }
+
+    def __init__(self, action, tag, page):
+        label, style = self.LABELS[action]
+        super().__init__(ui.Button(label=label, style=style, custom_id=f"cb:lb:{action}:{tag}:{page}", row=1))
+        self.action = action
+        self.tag = tag
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["action"], match["tag"], int(match["page"]))
+
+    async def callback(self, interaction: Interaction):
+        currency = currency_by_tag(interaction.guild.id, self.tag)
+        if currency is None:
+            await interaction.response.send_message("❌ This currency no longer exists.", ephemeral=True)
+            return
+        if self.action == "me":
+            rank = currencies_data[interaction.guild.id][currency]["balances"].rank(interaction.user.id)
+            if rank is None:
+                await interaction.response.send_message(f"❌ You don't have any `{currency}` yet.", ephemeral=True)
+                return
+            page = rank // LEADERBOARD_PAGE_SIZE
+        else:
+            page = self.page + (1 if self.action == "next" else -1)
+        await show_leaderboard_page(interaction, currency, page)
+
+
+class LeaderboardView(ui.View):
+    """The components of one leaderboard page; built per response and not kept once sent."""
+
+    def __init__(self, guild_currencies, currency, page):
+        super().__init__(timeout=None)
+        # Selects hold at most 25 options
+        options = [
+            SelectOption(label=name, description=f"View {name} leaderboard",
+                         emoji=data.get("emoji", None), default=name == currency)
+            for name, data in list(guild_currencies.items())[:25]
+        ]
+        tag = name_tag(currency)
+        self.select = LeaderboardSelect(options)
+        self.prev_page = LeaderboardButton("prev", tag, page)
+        self.next_page = LeaderboardButton("next", tag, page)
+        self.jump_to_me = LeaderboardButton("me", tag, page)
+        for item in (self.select, self.prev_page, self.next_page, self.jump_to_me):
+            self.add_item(item)
+
+
+async def show_leaderboard_page(interaction: Interaction, currency, page):
+    """Replace a leaderboard message with another page, clamped to the pages that exist."""
+    guild_currencies = currencies_data.get(interaction.guild.id, {})
+    page = max(0, min(page, leaderboard_pages(guild_currencies[currency]["balances"]) - 1))
+    embed = await make_leaderboard_embed(interaction.guild, interaction.user, currency, page)
+    await interaction.response.edit_message(embed=embed, view=LeaderboardView(guild_currencies, currency, page))
+
+
 @bot.tree.command(name="leaderboard", description="Show the top users for any currency.")
 async def leaderboard(interaction: Interaction):
     guild_id = interaction.guild.id
@@ -791,94 +3095,203 @@ async def leaderboard(interaction: Interaction):
         await interaction.response.send_message("❌ No currencies found for this server.", ephemeral=True)
         return
 
-    # Helper function to build leaderboard embed
-    def make_leaderboard_embed(currency_name: str):
-        balances = guild_currencies[currency_name]["balances"]
-        # Filter out users with 0 balance
-        nonzero_balances = {uid: amt for uid, amt in balances.items() if amt > 0}
+    # Default to first currency
+    first_currency = next(iter(guild_currencies.keys()))
+    embed = await make_leaderboard_embed(interaction.guild, interaction.user, first_currency)
+    view = LeaderboardView(guild_currencies, first_currency, 0)
+    await interaction.response.send_message(embed=embed, view=view)
 
-        if not nonzero_balances:
-            desc = f"❌ No one has any `{currency_name}` yet."
-        else:
-            top_users = sorted(nonzero_balances.items(), key=lambda x: x[1], reverse=True)[:10]
-            desc = ""
-            for i, (user_id, amount) in enumerate(top_users, start=1):
-                user = interaction.guild.get_member(user_id)
-                username = user.display_name if user else f"<Unknown User {user_id}>"
-                desc += f"**{i}. {username}** — {amount}\n"
-
-        emoji = guild_currencies[currency_name].get("emoji", "")
-        embed = Embed(
-            title=f"🏆 Leaderboard: {emoji} {currency_name}",
-            description=desc,
-            color=discord.Color.gold()
-        )
-        embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
+
+# --- /rank command ---
+def describe_rank(balances, user_id):
+    """One line with the user's position, percentile and gap to the next rank, from the rank index."""
+    rank = balances.rank(user_id)
+    if rank is None:
+        return "Unranked — no balance yet."
+    amount = balances[user_id]
+    holders = balances.holders()
+    line = f"**#{rank + 1}** of {holders} — {amount} (top {100 * (rank + 1) / holders:.1f}%)"
+    if rank == 0:
+        return line + "\n👑 Nobody is ahead!"
+    _, above_amount = balances.page(rank - 1, 1)[0]
+    return line + f"\n⬆️ {above_amount - amount + 1} more to reach #{rank}"
+
+
+@bot.tree.command(name="rank", description="Show where a user ranks for a currency.")
+@app_commands.describe(currency="Currency to rank by (optional, defaults to all)", user="User to check (optional)")
+@app_commands.autocomplete(currency=currency_autocomplete)
+async def rank(interaction: discord.Interaction, currency: str = None, user: discord.User = None):
+    guild_id = interaction.guild.id
+    user = user or interaction.user
+    guild_currencies = currencies_data.get(guild_id, {})
+
+    if not guild_currencies:
+        await interaction.response.send_message("❌ No currencies found for this server.", ephemeral=True)
+        return
+    if currency is not None and currency not in guild_currencies:
+        await interaction.response.send_message(f"❌ Currency `{currency}` not found!", ephemeral=True)
+        return
+
+    embed = discord.Embed(
+        title=f"📊 {user.display_name}'s Rank",
+        color=discord.Color.gold()
     )
-        embed.timestamp = datetime.now()
-        return embed
+    # Embeds hold at most 25 fields
+    for name in [currency] if currency is not None else list(guild_currencies)[:25]:
+        data = guild_currencies[name]
+        embed.add_field(
+            name=f"{data.get('emoji', '')} {name}",
+            value=describe_rank(data["balances"], user.id),
+            inline=False
+        )
+    add_footer(embed, interaction.user)
+    await interaction.response.send_message(embed=embed)
 
-    # Dropdown options for currencies
-    options = [
-        SelectOption(label=name, description=f"View {name} leaderboard",
-                     emoji=guild_currencies[name].get("emoji", None))
-        for name in guild_currencies.keys()
-    ]
 
-    class LeaderboardSelect(ui.Select):
-        def __init__(self):
-            super().__init__(
-                placeholder="Select a currency...",
-                options=options,
-                min_values=1,
-                max_values=1
-            )
 
-        async def callback(self, select_interaction: Interaction):
-            currency_selected = self.values[0]
-            embed = make_leaderboard_embed(currency_selected)
-            await select_interaction.response.edit_message(embed=embed, view=self.view)
+# --- /history and /audit commands ---
+LEDGER_PAGE_SIZE = 15
 
-    class LeaderboardView(ui.View):
-        def __init__(self):
-            super().__init__(timeout=None)
-            self.add_item(LeaderboardSelect())
 
-    # Default to first currency
-    first_currency = next(iter(guild_currencies.keys()))
-    embed = make_leaderboard_embed(first_currency)
-    view = LeaderboardView()
-    await interaction.response.send_message(embed=embed, view=view)
+@bot.tree.command(name="history", description="Show a user's recent transfers.")
+@app_commands.describe(user="User whose transfers to show", limit="How many transfers to show (max 15)")
+@app_commands.checks.has_permissions(manage_guild=True)
+@app_commands.default_permissions(manage_guild=True)
+async def history(interaction: discord.Interaction, user: discord.User, limit: int = 10):
+    guild_id = interaction.guild.id
+    limit = max(1, min(limit, LEDGER_PAGE_SIZE))
+    await interaction.response.defer(ephemeral=True)
+    (rows,) = await query_ledger((HISTORY_SQL, (guild_id, user.id, limit, guild_id, user.id, limit, limit)))
 
+    embed = discord.Embed(
+        title=f"📜 {user.display_name}'s History",
+        description="\n".join(format_ledger_row(row) for row in rows) or "No transfers recorded yet.",
+        color=discord.Color.blue()
+    )
+    add_footer(embed, interaction.user)
+    await interaction.followup.send(embed=embed, ephemeral=True)
 
 
-# --- /commands command ---
-@bot.tree.command(name="commands", description="Show all available commands for this bot.")
-async def commands_list(interaction: discord.Interaction):
-    all_cmds = bot.tree.get_commands(guild=None)
-  # get guild commands
-    if not all_cmds:
-        await interaction.response.send_message("❌ No commands found.", ephemeral=True)
+@bot.tree.command(name="audit", description="Summarize every transfer of a currency since a given time.")
+@app_commands.describe(currency="Currency to audit", since="How far back: e.g. 24h, 7d or 2025-01-31")
+@app_commands.autocomplete(currency=currency_autocomplete)
+@app_commands.checks.has_permissions(manage_guild=True)
+@app_commands.default_permissions(manage_guild=True)
+async def audit(interaction: discord.Interaction, currency: str, since: str = "24h"):
+    guild_id = interaction.guild.id
+    since_ts = parse_since(since)
+    if since_ts is None:
+        await interaction.response.send_message("❌ Use a duration like `24h` or `7d`, or a date like `2025-01-31`.", ephemeral=True)
         return
 
+    await interaction.response.defer(ephemeral=True)
+    summary, recent = await query_ledger(
+        (AUDIT_SUMMARY_SQL, (guild_id, currency, since_ts)),
+        (AUDIT_RECENT_SQL, (guild_id, currency, since_ts, LEDGER_PAGE_SIZE)),
+    )
+
     embed = discord.Embed(
-        title="🤖 Bot Commands",
-        description="Here are the available commands for this server:",
+        title=f"🔎 {currency} Audit",
+        description=f"Transfers since <t:{int(since_ts)}:f>",
         color=discord.Color.blue()
     )
+    if summary:
+        embed.add_field(
+            name=f"By reason ({sum(count for _, count, _ in summary)} transfers)",
+            value="\n".join(f"`{reason}`: {count} transfers, {total} total" for reason, count, total in summary)[:1024],
+            inline=False
+        )
+        embed.add_field(
+            name="Most recent",
+            value="\n".join(format_ledger_row(row) for row in recent)[:1024],
+            inline=False
+        )
+    else:
+        embed.description += "\nNo transfers recorded."
+    add_footer(embed, interaction.user)
+    await interaction.followup.send(embed=embed, ephemeral=True)
 
-    for cmd in all_cmds:
-        name = cmd.name
-        desc = cmd.description or "No description provided."
-        embed.add_field(name=f"/{name}", value=desc, inline=False)
 
-    embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-    embed.timestamp = datetime.now()
+# --- /commands command ---
+# The command set only changes when the tree is synced, so the catalog embed is built then,
+# once per combination of the permissions commands require, and /commands just picks one.
+
+COMMAND_GROUPS = {
+    "💰 Currency": ("balance", "give", "trade", "leaderboard", "rank", "list_currencies"),
+    "📚 Earning": ("homework", "officehours", "cooldowns"),
+    "🎲 Games": ("gamble", "jackpot", "rob"),
+    "🛍️ Shop": ("shop", "buy", "use", "inventory", "buffs"),
+    "ℹ️ Help": ("commands",),
+}
+ADMIN_GROUP = "🛠️ Admin"  # commands with default_permissions, whatever group they are in
+OTHER_GROUP = "📦 Other"
+FIELD_LIMIT = 1024  # characters Discord allows in an embed field value
+
+
+def catalog_fields(commands_by_group):
+    """Embed fields for { group: [command, ...] }, splitting a group across fields if it is too long."""
+    fields = []
+    for group, cmds in commands_by_group.items():
+        value = ""
+        for cmd in cmds:
+            line = f"`/{cmd.name}` — {cmd.description or 'No description provided.'}\n"
+            if value and len(value) + len(line) > FIELD_LIMIT:
+                fields.append({"name": group, "value": value, "inline": False})
+                value = ""
+            value += line
+        if value:
+            fields.append({"name": group, "value": value, "inline": False})
+    return fields
+
+
+class CommandCatalog:
+    def __init__(self):
+        self.requirements = []  # distinct default_permissions values, in first-seen order
+        self.embeds = {}  # (met requirement, ...) -> embed dict
+
+    def build(self, cmds):
+        group_of = {name: group for group, names in COMMAND_GROUPS.items() for name in names}
+        self.requirements = []
+        for cmd in cmds:
+            required = getattr(cmd, "default_permissions", None)
+            if required is not None and required not in self.requirements:
+                self.requirements.append(required)
+
+        self.embeds = {}
+        for met in itertools.product((False, True), repeat=len(self.requirements)):
+            allowed = {required for required, ok in zip(self.requirements, met) if ok}
+            by_group = {group: [] for group in (*COMMAND_GROUPS, OTHER_GROUP, ADMIN_GROUP)}
+            for cmd in cmds:
+                required = getattr(cmd, "default_permissions", None)
+                if required is None:
+                    by_group[group_of.get(cmd.name, OTHER_GROUP)].append(cmd)
+                elif required in allowed:
+                    by_group[ADMIN_GROUP].append(cmd)
+            self.embeds[met] = discord.Embed(
+                title="🤖 Bot Commands",
+                description="Here are the available commands for this server:",
+                color=discord.Color.blue()
+            ).to_dict() | {"fields": catalog_fields({group: cmds for group, cmds in by_group.items() if cmds})}
+
+    def embed_for(self, permissions):
+        """A fresh embed listing the commands `permissions` can use."""
+        if not self.embeds:
+            self.build(bot.tree.get_commands(guild=None))
+        met = tuple(required <= permissions for required in self.requirements)
+        return discord.Embed.from_dict(self.embeds[met])
+
+
+command_catalog = CommandCatalog()
+
+
+@bot.tree.command(name="commands", description="Show all available commands for this bot.")
+async def commands_list(interaction: discord.Interaction):
+    embed = command_catalog.embed_for(interaction.permissions)
+    if not embed.fields:
+        await interaction.response.send_message("❌ No commands found.", ephemeral=True)
+        return
+
+    add_footer(embed, interaction.user)
 
     await interaction.response.send_message(embed=embed)
 
@@ -891,6 +3304,7 @@ from discord import Interaction, Embed
 )
 @app_commands.autocomplete(old_name=currency_autocomplete)
 @app_commands.checks.has_permissions(manage_guild=True)
+@app_commands.default_permissions(manage_guild=True)
 async def rename(interaction: Interaction, old_name: str, new_name: str):
     guild_id = interaction.guild.id
     guild_currencies = currencies_data.get(guild_id, {})
@@ -903,9 +3317,17 @@ async def rename(interaction: Interaction, old_name: str, new_name: str):
         await interaction.response.send_message(f"❌ Currency `{new_name}` already exists.", ephemeral=True)
         return
 
+    clash = tag_collision(guild_id, new_name, ignore=old_name)
+    if clash is not None:
+        await interaction.response.send_message(
+            f"❌ `{new_name}` can't be told apart from `{clash}` in buttons. Please pick another name.",
+            ephemeral=True
+        )
+        return
+
     # Rename currency
-    guild_currencies[new_name] = guild_currencies.pop(old_name)
-    save_db()
+    rename_guild_currency(guild_id, old_name, new_name)
+    await commit_db()
 
     embed = Embed(
         title="✅ Currency Renamed",
@@ -924,9 +3346,13 @@ from datetime import datetime
 import discord
 from discord.ext import commands
 
-class TradeView(discord.ui.View):
+TRADE_SECONDS = 60
+
+
+class PendingTrade:
+    """A proposed trade waiting for both sides to confirm; kept in view_registry."""
+
     def __init__(self, author, target, give_currency, give_amount, receive_currency, receive_amount, guild_id):
-        super().__init__(timeout=60)
         self.author = author
         self.target = target
         self.give_currency = give_currency
@@ -939,18 +3365,26 @@ class TradeView(discord.ui.View):
         self.trade_completed = False
 
     async def complete_trade(self, interaction):
-        """Perform the trade after both confirm."""
-        guild_currencies = currencies_data[self.guild_id]
-
-        # Deduct & add currency for both users
-        guild_currencies[self.give_currency]["balances"][self.author.id] -= self.give_amount
-        guild_currencies[self.give_currency]["balances"][self.target.id] += self.give_amount
-        guild_currencies[self.receive_currency]["balances"][self.target.id] -= self.receive_amount
-        guild_currencies[self.receive_currency]["balances"][self.author.id] += self.receive_amount
-
-
-        save_db()
+        """Perform the trade after both confirm, re-checking both balances under the account locks."""
         self.trade_completed = True
+        try:
+            async with transaction(self.guild_id, self.author.id, self.target.id) as txn:
+                txn.transfer(self.give_currency, self.author.id, self.target.id, self.give_amount, "trade")
+                txn.transfer(self.receive_currency, self.target.id, self.author.id, self.receive_amount, "trade")
+        except TransactionError as e:
+            if isinstance(e, InsufficientFunds):
+                who = self.author if e.account == self.author.id else self.target
+                reason = f"{who.mention} no longer has {e.needed} {e.currency}."
+            else:
+                reason = str(e)
+            embed = discord.Embed(
+                title="❌ Trade Failed",
+                description=f"The trade between {self.author.mention} and {self.target.mention} could not be completed: {reason}",
+                color=discord.Color.red()
+            )
+            embed.timestamp = datetime.now()
+            await interaction.response.edit_message(embed=embed, view=None)
+            return
 
         embed = discord.Embed(
             title="✅ Trade Completed!",
@@ -963,14 +3397,17 @@ class TradeView(discord.ui.View):
                         value=f"{self.receive_amount} {self.receive_currency}", inline=True)
         embed.timestamp = datetime.now()
 
-        await interaction.message.edit(embed=embed, view=None)
+        await interaction.response.edit_message(embed=embed, view=None)
 
-    @discord.ui.button(label="Confirm", style=discord.ButtonStyle.green)
-    async def confirm(self, interaction: discord.Interaction, button: discord.ui.Button):
+    async def confirm(self, interaction):
         if interaction.user not in [self.author, self.target]:
             await interaction.response.send_message("❌ You’re not part of this trade!", ephemeral=True)
             return
 
+        if self.trade_completed:
+            await interaction.response.send_message("❌ This trade is already being completed.", ephemeral=True)
+            return
+
         if interaction.user == self.author:
             self.author_confirmed = True
         elif interaction.user == self.target:
@@ -981,12 +3418,16 @@ class TradeView(discord.ui.View):
         else:
             await interaction.response.send_message("✅ You’ve confirmed your side of the trade. Waiting for the other user...", ephemeral=True)
 
-    @discord.ui.button(label="Cancel", style=discord.ButtonStyle.red)
-    async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
+    async def cancel(self, interaction, key):
         if interaction.user not in [self.author, self.target]:
             await interaction.response.send_message("❌ You’re not part of this trade!", ephemeral=True)
             return
 
+        if self.trade_completed:
+            await interaction.response.send_message("❌ This trade is already being completed.", ephemeral=True)
+            return
+
+        view_registry.pop(key)
         embed = discord.Embed(
             title="❌ Trade Cancelled",
             description=f"The trade between {self.author.mention} and {self.target.mention} was cancelled.",
@@ -994,8 +3435,43 @@ class TradeView(discord.ui.View):
         )
         embed.timestamp = datetime.now()
 
-        await interaction.message.edit(embed=embed, view=None)
-        self.stop()
+        await interaction.response.edit_message(embed=embed, view=None)
+
+
+class TradeButton(GuildComponent, discord.ui.DynamicItem[discord.ui.Button], template=r"cb:trade:(?P<action>confirm|cancel):(?P<key>[0-9a-f]{12})"):
+    def __init__(self, action, key):
+        if action == "confirm":
+            label, style = "Confirm", discord.ButtonStyle.green
+        else:
+            label, style = "Cancel", discord.ButtonStyle.red
+        super().__init__(discord.ui.Button(label=label, style=style, custom_id=f"cb:trade:{action}:{key}"))
+        self.action = action
+        self.key = key
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["action"], match["key"])
+
+    async def callback(self, interaction: discord.Interaction):
+        trade = view_registry.get(self.key)
+        if trade is None:
+            await interaction.response.send_message("❌ This trade has expired or was cancelled.", ephemeral=True)
+            return
+        if self.action == "confirm":
+            await trade.confirm(interaction)
+        else:
+            await trade.cancel(interaction, self.key)
+
+
+class TradeView(discord.ui.View):
+    """The Confirm / Cancel buttons of a trade proposal; the trade itself is in view_registry."""
+
+    def __init__(self, key):
+        super().__init__(timeout=None)
+        self.confirm = TradeButton("confirm", key)
+        self.cancel = TradeButton("cancel", key)
+        self.add_item(self.confirm)
+        self.add_item(self.cancel)
 
 
 @bot.tree.command(name="trade", description="Propose a trade with another user.")
@@ -1020,6 +3496,10 @@ async def trade(interaction: discord.Interaction, user: discord.User,
         await interaction.response.send_message("❌ You can’t trade with yourself!", ephemeral=True)
         return
 
+    if give_amount <= 0 or receive_amount <= 0:
+        await interaction.response.send_message("❌ Trade amounts must be greater than zero.", ephemeral=True)
+        return
+
     if guild_id not in currencies_data:
         await interaction.response.send_message("❌ No currencies found for this server.", ephemeral=True)
         return
@@ -1032,16 +3512,11 @@ async def trade(interaction: discord.Interaction, user: discord.User,
     give_balances = guild_currencies[give_currency]["balances"]
     receive_balances = guild_currencies[receive_currency]["balances"]
 
-    give_balances.setdefault(author_id, 0)
-    give_balances.setdefault(target_id, 0)
-    receive_balances.setdefault(author_id, 0)
-    receive_balances.setdefault(target_id, 0)
-
-    if give_balances[author_id] < give_amount:
+    if give_balances.get(author_id, 0) < give_amount:
         await interaction.response.send_message(f"❌ You don’t have enough {give_currency} to trade.", ephemeral=True)
         return
 
-    if receive_balances[target_id] < receive_amount:
+    if receive_balances.get(target_id, 0) < receive_amount:
         await interaction.response.send_message(f"❌ {user.display_name} doesn’t have enough {receive_currency} to trade.", ephemeral=True)
         return
 
@@ -1057,8 +3532,9 @@ async def trade(interaction: discord.Interaction, user: discord.User,
     embed.set_footer(text="Both users must confirm within 60 seconds.")
     embed.timestamp = datetime.now()
 
-    view = TradeView(interaction.user, user, give_currency, give_amount,
-                     receive_currency, receive_amount, guild_id)
+    pending = PendingTrade(interaction.user, user, give_currency, give_amount,
+                           receive_currency, receive_amount, guild_id)
+    view = TradeView(view_registry.add(pending, TRADE_SECONDS))
 
     await interaction.response.send_message(
     content=f"{user.mention}, you’ve received a trade request from {interaction.user.mention}!",
@@ -1084,68 +3560,36 @@ async def gamble(interaction: discord.Interaction, currency: str, amount: int):
         await interaction.response.send_message(f"❌ Currency `{currency}` not found.", ephemeral=True)
         return
 
-    balances = guild_currencies[currency]["balances"]
-    user_balance = balances.get(user_id, 0)
-
     if amount <= 0:
         await interaction.response.send_message("❌ Amount must be greater than 0.", ephemeral=True)
         return
 
-    if user_balance < amount:
+    try:
+        async with transaction(guild_id, user_id, JACKPOT_ACCOUNT) as txn:
+            win, jackpot_winnings = settle_gamble(txn, user_id, currency, amount)
+    except InsufficientFunds:
         await interaction.response.send_message("❌ You don’t have enough to gamble.", ephemeral=True)
         return
+    except TransactionError as e:
+        await interaction.response.send_message(f"❌ {e}", ephemeral=True)
+        return
 
-    emoji = guild_currencies[currency].get("emoji", "💰")
-    win = random.random() < 0.5  # 50% chance
-    result_text = ""
-
+    emoji = guild_currencies.get(currency, {}).get("emoji", "💰")
     if win:
-    # 🏆 Add winnings
-        winnings = amount
-        balances[user_id] = user_balance + winnings
-        result_text = f"🎉 {interaction.user.mention} **won** {winnings} {currency} {emoji}!"
-
-
-        # 🎯 0.1% * bet jackpot chance
-        jackpot_chance = min(0.002 * amount, 0.5)  # e.g., 0.002 * 500 = 1.0 (100%)
-        if random.random() < jackpot_chance:
-            guild_pot = jackpots.get(guild_id, {})
-            jackpot_text = ""
-
-            for cur_name, pot_amount in guild_pot.items():
-                if pot_amount > 0:
-                    guild_currencies[cur_name]["balances"][user_id] = (
-                        guild_currencies[cur_name]["balances"].get(user_id, 0) + pot_amount
-                    )
-                    jackpot_text += f"\n🎉 You also won {pot_amount} {guild_currencies[cur_name]['emoji']} **{cur_name}** from the jackpot!"
-
-            # Reset the pot
-            jackpots[guild_id] = {cur: 0 for cur in guild_pot}
-
-            if jackpot_text:
-                result_text += jackpot_text
-
+        # 🏆 Add winnings
+        result_text = f"🎉 {interaction.user.mention} **won** {amount} {currency} {emoji}!"
+        for cur_name, pot_amount in jackpot_winnings.items():
+            result_text += f"\n🎉 You also won {pot_amount} {guild_currencies[cur_name]['emoji']} **{cur_name}** from the jackpot!"
     else:
         # 💸 Lose coins
-        balances[user_id] = user_balance - amount
         result_text = f"😢 You **lost** {amount} {currency} {emoji} . \nAdded to the server’s pot. Use /jackpot to view this server's current pot."
 
-        # Add lost coins to that currency’s jackpot pool
-        jackpots.setdefault(guild_id, {}).setdefault(currency, 0)
-        jackpots[guild_id][currency] += amount
-
-    save_db()
-
     embed = discord.Embed(
         title=f"{emoji} Gamble Result",
         description=result_text,
         color=discord.Color.green() if win else discord.Color.red()
     )
-    embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-    embed.timestamp = datetime.now()
+    add_footer(embed, interaction.user)
     await interaction.response.send_message(embed=embed)
 
 # --- /jackpot command ---
@@ -1155,46 +3599,74 @@ async def jackpot(interaction: discord.Interaction):
     guild_currencies = currencies_data.get(guild_id, {})
     guild_pot = jackpots.get(guild_id, {})
 
-    if not guild_pot or all(v == 0 for v in guild_pot.values()):
-        embed = discord.Embed(
-            title="💰 Jackpot Pot",
-            description="The jackpot is currently **empty**! No coins have been lost yet.",
-            color=discord.Color.orange()
-        )
-    else:
+    def build():
+        """The pot's lines, or "" when the pot is empty."""
+        if not guild_pot or all(v == 0 for v in guild_pot.values()):
+            return ""
         description_lines = []
         for cur_name, amount in guild_pot.items():
             if amount > 0:
                 emoji = guild_currencies.get(cur_name, {}).get("emoji", "💰")
                 description_lines.append(f"{emoji} **{cur_name}**: {amount}")
 
-        description = "\n".join(description_lines) if description_lines else "No jackpot funds currently available."
+        return "\n".join(description_lines) if description_lines else "No jackpot funds currently available."
 
+    description = cached_render(guild_id, ("jackpot",), ("currencies", "jackpots"), build)
+    if not description:
+        embed = discord.Embed(
+            title="💰 Jackpot Pot",
+            description="The jackpot is currently **empty**! No coins have been lost yet.",
+            color=discord.Color.orange()
+        )
+    else:
         embed = discord.Embed(
             title="💎 Server Jackpot Pot",
             description=description,
             color=discord.Color.gold()
         )
 
-    embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-    embed.timestamp = datetime.now()
+    add_footer(embed, interaction.user)
 
     await interaction.response.send_message(embed=embed)
 
+def pick_rob_target(guild, robber_id, currency=None):
+    """
+    Pick a random victim weighted by their balance in `currency` (or in a random currency
+    of the guild). The robber, users with an RF Shield up and known bots are never drawn.
+    Returns (currency_name, user_id), or None if nobody robbable holds anything.
+    """
+    guild_currencies = currencies_data.get(guild.id, {})
+    shielded = {user_id for user_id, buffs in active_buffs.get(guild.id, {}).items() if "rf_shield" in buffs}
+    names = [currency] if currency else list(guild_currencies)
+    random.shuffle(names)
+    for name in names:
+        balances = guild_currencies[name]["balances"]
+        exclude = shielded | {robber_id}
+        user_id = balances.sample_holder(exclude)
+        while user_id is not None:
+            member = guild.get_member(user_id)
+            if member is None or not member.bot:
+                return name, user_id
+            # Bots can't be robbed; draw again without this one
+            exclude.add(user_id)
+            user_id = balances.sample_holder(exclude)
+    return None
+
+
 @bot.tree.command(name="rob", description="Try to rob another user for some currency!")
-@app_commands.describe(user="The user you want to rob")
-async def rob(interaction: discord.Interaction, user: discord.User):
+@app_commands.describe(
+    user="The user you want to rob (leave empty to pick a random victim, richer users are likelier)",
+    currency="Only steal this currency (optional)"
+)
+@app_commands.autocomplete(currency=currency_autocomplete)
+async def rob(interaction: discord.Interaction, user: discord.User = None, currency: str = None):
     guild_id = interaction.guild.id
     author_id = interaction.user.id
-    target_id = user.id
 
-    if user.bot:
+    if user is not None and user.bot:
         await interaction.response.send_message("🤖 You can’t rob bots!", ephemeral=True)
         return
-    if author_id == target_id:
+    if user is not None and author_id == user.id:
         await interaction.response.send_message("🙄 You can’t rob yourself.", ephemeral=True)
         return
 
@@ -1202,89 +3674,87 @@ async def rob(interaction: discord.Interaction, user: discord.User):
     if not guild_currencies:
         await interaction.response.send_message("❌ This server has no currencies set up.", ephemeral=True)
         return
+    if currency is not None and currency not in guild_currencies:
+        await interaction.response.send_message(f"❌ Currency `{currency}` does not exist.", ephemeral=True)
+        return
 
     # --- Rob cooldown ---
-    now = time.time()
-    # Default cooldown: 6 hours if not set
-    COOLDOWN = guild_cooldowns.get(guild_id, {}).get("rob", 6 * 60 * 60)
-    last_time = rob_cooldowns.get(guild_id, {}).get(author_id, 0)
-
-    if now - last_time < COOLDOWN:
-        remaining = int(COOLDOWN - (now - last_time))
+    def wait_message(remaining):
         # Format as H:M:S
         hours, remainder = divmod(remaining, 3600)
         minutes, seconds = divmod(remainder, 60)
         remaining_str = f"{hours}h {minutes}m {seconds}s" if hours else f"{minutes}m {seconds}s"
-        await interaction.response.send_message(
-            f"⏱ You need to wait **{remaining_str}** before robbing again!",
-            ephemeral=True
-        )
+        return f"⏱ You need to wait **{remaining_str}** before robbing again!"
+
+    remaining = int(cooldown_engine.remaining(guild_id, author_id, "rob", time.time()))
+    if remaining > 0:
+        await interaction.response.send_message(wait_message(remaining), ephemeral=True)
+        return
+
+    # --- Random mode: weighted pick of a victim ---
+    if user is None:
+        picked = pick_rob_target(interaction.guild, author_id, currency)
+        if picked is None:
+            await interaction.response.send_message("💤 Nobody has anything to steal right now!", ephemeral=True)
+            return
+        currency, target_id = picked
+        target_mention = f"<@{target_id}>"
+    else:
+        target_id = user.id
+        target_mention = user.mention
+
+    # --- Attempt robbery, with the cooldown stamped in the same commit ---
+    try:
+        async with transaction(guild_id, author_id, target_id, JACKPOT_ACCOUNT) as txn:
+            # Check again under the locks: another /rob by this user may have stamped it while this one waited
+            now = time.time()
+            remaining = int(cooldown_engine.remaining(guild_id, author_id, "rob", now))
+            if remaining > 0:
+                raise CooldownActive(remaining)
+            shielded = "rf_shield" in active_buffs.get(guild_id, {}).get(target_id, set())
+            if shielded:
+                # Remove RF Shield after it blocks a robbery; the attempt still costs the cooldown
+                set_buff(guild_id, target_id, "rf_shield", False)
+                outcome = None
+            else:
+                outcome = attempt_robbery(txn, author_id, target_id, currency)
+            if shielded or outcome is not None:
+                cooldown_engine.stamp(guild_id, author_id, "rob", now)
+    except CooldownActive as e:
+        await interaction.response.send_message(wait_message(e.remaining), ephemeral=True)
+        return
+    except TransactionError as e:
+        await interaction.response.send_message(f"❌ {e}", ephemeral=True)
         return
 
-    target_buffs = active_buffs.get(guild_id, {}).get(target_id, set())
-    if "rf_shield" in target_buffs:
-        # Remove RF Shield after it blocks a robbery
-        target_buffs.remove("rf_shield")
-        save_db()
+    if shielded:
         await interaction.response.send_message(
-            f"🛡️ {user.mention}'s RF Shield protected them from your robbery attempt!"
+            f"🛡️ {target_mention}'s RF Shield protected them from your robbery attempt!"
         )
         return
-    
-    # --- Pick random currency victim actually has ---
-    nonzero_currencies = [
-        (name, data)
-        for name, data in guild_currencies.items()
-        if data["balances"].get(target_id, 0) > 0
-    ]
-
-    if not nonzero_currencies:
+    if outcome is None:
         await interaction.response.send_message(
-            f"💤 {user.mention} has no currencies to steal!",
+            f"💤 {target_mention} has no {currency or 'currencies'} to steal!",
             ephemeral=True
         )
         return
 
-    currency_name, currency_data = random.choice(nonzero_currencies)
-    balances = currency_data["balances"]
-    emoji = currency_data.get("emoji", "💰")
-
-    robber_balance = balances.get(author_id, 0)
-    victim_balance = balances.get(target_id, 0)
-
-    # --- Attempt robbery ---
-    amount = random.randint(1, min(50, victim_balance))  # cap at 50 or victim’s balance
-    success = random.random() < 0.5  # 50% chance to succeed
-
+    currency_name, success, amount = outcome
+    emoji = guild_currencies[currency_name].get("emoji", "💰")
     if success:
-        balances[target_id] = victim_balance - amount
-        balances[author_id] = robber_balance + amount
-        result_text = f"😈 {interaction.user.mention} **successfully robbed** {user.mention} and stole **{emoji} {amount} {currency_name}!**"
+        result_text = f"😈 {interaction.user.mention} **successfully robbed** {target_mention} and stole **{emoji} {amount} {currency_name}!**"
         color = discord.Color.green()
     else:
-        max_penalty = min(50, robber_balance)
-        penalty = random.randint(1, max_penalty) if max_penalty > 0 else 0
-        balances[author_id] = max(0, robber_balance - penalty)
-        jackpots.setdefault(guild_id, {}).setdefault(currency_name, 0)
-        jackpots[guild_id][currency_name] += penalty
-        result_text = f"🚓 {interaction.user.mention} got **caught** trying to rob {user.mention} and paid **{emoji} {penalty} {currency_name}** into the jackpot!"
+        result_text = f"🚓 {interaction.user.mention} got **caught** trying to rob {target_mention} and paid **{emoji} {amount} {currency_name}** into the jackpot!"
         color = discord.Color.red()
 
-    # --- Save cooldown + DB ---
-    rob_cooldowns.setdefault(guild_id, {})[author_id] = now
-    save_db()
-
     # --- Embed response ---
     embed = discord.Embed(
         title="💸 Robbery Attempt",
         description=result_text,
         color=color
     )
-    embed.set_footer(
-    text=f"Requested by {interaction.user}\nCurrencies in this bot have no value and are not sponsored by the ECE department.\n",
-    icon_url=interaction.user.avatar.url if interaction.user.avatar else None
-    )
-    embed.timestamp = datetime.now()
+    add_footer(embed, interaction.user)
 
     await interaction.response.send_message(embed=embed)
 
@@ -1308,25 +3778,24 @@ shop_items = {
 @bot.tree.command(name="shop", description="View items available for purchase")
 async def shop(interaction: discord.Interaction):
     embed = discord.Embed(title="🛍️ ECE Shop", color=discord.Color.gold())
-    for name, item in shop_items.items():
-        embed.add_field(
-            name=f"{item['emoji']} {name.replace('_', ' ').title()} — {item['price']} currency",
-            value=item["description"],
-            inline=False
-        )
+    fields = cached_render(None, ("shop",), (), lambda: [
+        (f"{item['emoji']} {name.replace('_', ' ').title()} — {item['price']} currency", item["description"])
+        for name, item in shop_items.items()
+    ])
+    for name, value in fields:
+        embed.add_field(name=name, value=value, inline=False)
     await interaction.response.send_message(embed=embed)
 
+item_index = NameIndex(shop_items)
+
+
 async def item_autocomplete(interaction: discord.Interaction, current: str):
     """Autocomplete shop items based on what the user types."""
-    guild_id = interaction.guild.id
-    current_lower = current.lower()
-
-    # Return all items that start with current input
+    # Items starting with the input come first, then items containing it
     return [
         app_commands.Choice(name=item.replace("_", " ").title(), value=item)
-        for item in shop_items.keys()
-        if item.startswith(current_lower)
-    ][:25] 
+        for item in item_index.search(current, 25)
+    ]
 
 @bot.tree.command(name="buy", description="Buy an item from the shop")
 @app_commands.describe(item="The item to buy", currency="Currency to spend")
@@ -1357,13 +3826,13 @@ async def buy(interaction: discord.Interaction, item: str, currency: str):
         return
 
     # Deduct currency
-    balances[user_id] = user_balance - price
+    set_user_balance(guild_id, currency, user_id, user_balance - price)
+    ledger.record(guild_id, user_id, None, currency, price, f"buy:{item}")
 
     # Add item to inventory
-    inventories.setdefault(guild_id, {}).setdefault(user_id, {})
-    inventories[guild_id][user_id][item] = inventories[guild_id][user_id].get(item, 0) + 1
+    set_inventory_qty(guild_id, user_id, item, inventories.get(guild_id, {}).get(user_id, {}).get(item, 0) + 1)
 
-    save_db()
+    await commit_db()
     emoji = shop_items[item].get("emoji", "")
     currency_emoji = guild_currencies[currency].get("emoji", "💰")
     await interaction.response.send_message(
@@ -1384,31 +3853,30 @@ async def use(interaction: discord.Interaction, item: str):
         return
 
     # Check if buff already exists
-    user_buffs = active_buffs.setdefault(guild_id, {}).setdefault(user_id, set())
+    user_buffs = active_buffs.get(guild_id, {}).get(user_id, set())
 
     if item == "energy_drink":
         # Energy drink can always be used (removes rob cooldown)
-        rob_cooldowns.get(guild_id, {}).pop(user_id, None)
-        await interaction.response.send_message("⚡ You feel energized! Rob cooldown cleared.")
+        cooldown_engine.clear(guild_id, user_id, "rob")
+        message, ephemeral = "⚡ You feel energized! Rob cooldown cleared.", False
 
     elif item == "rf_shield":
         if "rf_shield" in user_buffs:
             await interaction.response.send_message("🛡️ You already have an active RF Shield!", ephemeral=True)
             return
         # Activate RF Shield
-        user_buffs.add("rf_shield")
-        await interaction.response.send_message("🛡️ RF Shield active until you are robbed!", ephemeral=True)
+        set_buff(guild_id, user_id, "rf_shield", True)
+        message, ephemeral = "🛡️ RF Shield active until you are robbed!", True
 
     else:
         await interaction.response.send_message("❌ You can't use that item!", ephemeral=True)
         return
 
     # Consume item
-    inv[item] -= 1
-    if inv[item] <= 0:
-        del inv[item]
+    set_inventory_qty(guild_id, user_id, item, inv[item] - 1)
 
-    save_db()
+    await commit_db()
+    await interaction.response.send_message(message, ephemeral=ephemeral)
 
 
 @bot.tree.command(name="buffs", description="View your active buffs")
@@ -1484,10 +3952,50 @@ async def on_ready():
     print(f"✅ Logged in as {bot.user}")
     try:
         await bot.tree.sync()
+        command_catalog.build(bot.tree.get_commands(guild=None))
 
     except Exception as e:
         print(f"❌ Sync failed: {e}")
 
+@bot.event
+async def setup_hook():
+    # Let SIGTERM close the bot cleanly so pending writes are flushed below
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+    except NotImplementedError:  # Windows
+        pass
+    asyncio.create_task(eviction_loop())
+    asyncio.create_task(cooldown_purge_loop())
+    asyncio.create_task(loop_watchdog.heartbeat())
+    # Components on messages sent before a restart are routed by their custom_id patterns
+    bot.add_dynamic_items(LeaderboardSelect, LeaderboardButton, ConfirmRemoveButton, TradeButton)
+    if METRICS_PORT:
+        await start_metrics_server()
+
+
+@bot.event
+async def on_app_command_completion(interaction, command):
+    record_command(interaction, "ok")
+
+
+@bot.event
+async def on_interaction(interaction):
+    # Every interaction carries its author's member data, so their name is free to cache
+    if interaction.guild_id is not None:
+        display_names.remember(interaction.guild_id, interaction.user.id, interaction.user.display_name)
+
 # --- Run Bot ---
-bot.run("")
+if __name__ == "__main__":
+    load_db()
+    db_writer.start()
+    if "--compact" in sys.argv[1:]:
+        # Maintenance: rewrite every guild's rows from scratch, then exit
+        print(f"🧹 Compacted {compact_all_guilds()} guilds")
+        shutdown_db()
+        sys.exit(0)
+    threading.Thread(target=snapshot_loop, name="snapshot", daemon=True).start()
+    try:
+        bot.run("")
+    finally:
+        shutdown_db()
 
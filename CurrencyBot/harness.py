@@ -0,0 +1,146 @@
+"""
+Headless harness: stand-ins for the parts of discord.Interaction, Guild, Member and the
+response objects that the command handlers use, so handlers can be driven without Discord.
+
+    cb = load_bot_module(workdir)
+    interaction = FakeInteraction(guild_id, FakeMember(user_id))
+    await invoke(cb.balance, interaction)
+    print(interaction.text())
+"""
+import importlib.util
+import os
+
+import discord
+
+
+def load_bot_module(workdir):
+    """Import code.py without starting the bot, pointed at files inside workdir."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code.py")
+    spec = importlib.util.spec_from_file_location("currencybot", path)
+    bot_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot_module)
+    bot_module.DB_PATH = os.path.join(workdir, "currencies.db")
+    bot_module.JOURNAL_PATH = os.path.join(workdir, "currencies.journal")
+    bot_module.SNAPSHOT_PATH = os.path.join(workdir, "currencies.snapshot")
+    return bot_module
+
+
+class FakeMember:
+    def __init__(self, user_id, bot=False, permissions=None):
+        self.id = user_id
+        self.bot = bot
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.avatar = None
+        self.guild_permissions = permissions or discord.Permissions.none()
+
+    def __str__(self):
+        return self.name
+
+    def __eq__(self, other):
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeGuild:
+    """A guild where every user id resolves to a member, without keeping a member list."""
+
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+
+    def get_member(self, user_id):
+        return FakeMember(user_id)
+
+    async def fetch_member(self, user_id):
+        return FakeMember(user_id)
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+
+    def respond(self, content, kwargs):
+        if self.done:
+            raise discord.InteractionResponded(self.interaction)
+        self.done = True
+        self.interaction.replies.append((content, kwargs))
+
+    async def send_message(self, content=None, **kwargs):
+        self.respond(content, kwargs)
+
+    async def edit_message(self, **kwargs):
+        self.respond(None, kwargs)
+
+    async def defer(self, **kwargs):
+        self.respond(None, kwargs)
+
+    def is_done(self):
+        return self.done
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        self.interaction.replies.append((content, kwargs))
+
+
+class FakeMessage:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def edit(self, **kwargs):
+        self.interaction.edits.append(kwargs)
+
+
+class FakeInteraction:
+    def __init__(self, guild_id, user):
+        self.guild = FakeGuild(guild_id)
+        self.guild_id = guild_id
+        self.user = user
+        self.permissions = user.guild_permissions
+        self.command = None  # set by invoke()
+        self.replies = []  # (content, kwargs) for every response and followup
+        self.edits = []  # kwargs of every message.edit()
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.message = FakeMessage(self)
+        self.extras = {}
+
+    def text(self):
+        """The last reply's content, or its embed description."""
+        content, kwargs = self.replies[-1] if self.replies else (None, {})
+        embed = kwargs.get("embed")
+        return content or (embed.description if embed is not None else "") or ""
+
+    def view(self):
+        """The view attached to the last reply, if any."""
+        return self.replies[-1][1].get("view") if self.replies else None
+
+
+async def invoke(command, interaction, *args, **kwargs):
+    """Run a slash command's handler directly, skipping Discord's checks and argument parsing."""
+    interaction.command = command
+    await command.callback(interaction, *args, **kwargs)
+    return interaction
+
+
+async def press(item, interaction, values=None):
+    """
+    Press a button or pick `values` from a select on a view. Dynamic items are rebuilt from
+    their custom_id first, as discord.py does when a component is used.
+    """
+    if isinstance(item, discord.ui.DynamicItem):
+        match = item.__discord_ui_compiled_template__.fullmatch(item.custom_id)
+        item = await type(item).from_custom_id(interaction, item.item, match)
+    if values is not None:
+        select = item.item if isinstance(item, discord.ui.DynamicItem) else item
+        select._values = values  # what discord.py fills in from the interaction payload
+    await item.callback(interaction)
+    return interaction
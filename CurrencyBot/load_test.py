@@ -0,0 +1,260 @@
+"""
+Load test: generate a realistic trace of slash commands across many guilds (Zipf-like
+activity: a few busy guilds and users, a long quiet tail), replay it through the command
+handlers at a target rate against a simulated Discord API, and report whether the bot
+keeps up with Discord's 3-second response deadline.
+
+Usage:
+  python load_test.py --rate 200 500 1000 --duration 20
+  python load_test.py --rate 500 --save-trace trace.jsonl   # keep the generated trace
+  python load_test.py --trace trace.jsonl                   # replay a saved trace as recorded
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from harness import FakeInteraction, FakeMember, FakeResponse, invoke, load_bot_module, press
+
+CURRENCIES = ("gold", "silver", "bronze")
+DEADLINE = 3.0  # seconds Discord allows before an interaction must be answered
+API_LATENCY = (0.03, 0.12)  # simulated round trip of a response call, in seconds
+LAG_PROBE_INTERVAL = 0.05
+
+# Relative frequency of each command in generated traffic
+COMMAND_MIX = {
+    "homework": 25, "balance": 25, "gamble": 20, "officehours": 5, "give": 8,
+    "rob": 6, "leaderboard": 5, "trade": 4, "rank": 2,
+}
+
+
+def zipf_weights(n, s=1.1):
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+
+def generate_trace(rate, duration, guilds, users, seed=0):
+    """[(at_seconds, command, guild_id, user_id, other_id), ...] with Poisson arrivals at `rate`/s."""
+    rng = random.Random(seed)
+    guild_ids = list(range(1, guilds + 1))
+    guild_weights = zipf_weights(guilds)
+    user_weights = zipf_weights(users)
+    commands, command_weights = zip(*COMMAND_MIX.items())
+    trace = []
+    at = 0.0
+    while True:
+        at += rng.expovariate(rate)
+        if at >= duration:
+            return trace
+        guild_id = rng.choices(guild_ids, guild_weights)[0]
+        user_id, other_id = rng.choices(range(1, users + 1), user_weights, k=2)
+        if other_id == user_id:
+            other_id = user_id % users + 1
+        trace.append((at, rng.choices(commands, command_weights)[0], guild_id, user_id, other_id))
+
+
+def populate(cb, guilds, users):
+    conn = cb.db.connect()
+    cb.create_tables(conn)
+    rng = random.Random(0)
+    with conn:
+        for guild_id in range(1, guilds + 1):
+            conn.executemany("INSERT INTO currencies VALUES (?, ?, ?)", [(guild_id, name, "💰") for name in CURRENCIES])
+            conn.executemany("INSERT INTO jackpots VALUES (?, ?, 0)", [(guild_id, name) for name in CURRENCIES])
+            conn.execute("INSERT INTO guild_settings VALUES (?, 60, 60, 60)", (guild_id,))
+            conn.executemany("INSERT INTO balances VALUES (?, ?, ?, ?)",
+                             [(guild_id, user_id, name, rng.randint(0, 5000))
+                              for name in CURRENCIES for user_id in range(1, users + 1)])
+        cb.bump_generation(conn)
+
+
+# --- Simulated Discord API ---
+
+class SimulatedResponse(FakeResponse):
+    """Records when the first response call was made, then waits out a simulated round trip."""
+
+    async def respond_later(self, content, kwargs):
+        self.respond(content, kwargs)
+        self.interaction.answered_at = time.perf_counter()
+        await asyncio.sleep(random.uniform(*API_LATENCY))
+
+    async def send_message(self, content=None, **kwargs):
+        await self.respond_later(content, kwargs)
+
+    async def edit_message(self, **kwargs):
+        await self.respond_later(None, kwargs)
+
+    async def defer(self, **kwargs):
+        await self.respond_later(None, kwargs)
+
+
+class SimulatedInteraction(FakeInteraction):
+    def __init__(self, guild_id, user, created_at):
+        super().__init__(guild_id, user)
+        self.response = SimulatedResponse(self)
+        self.created_at = created_at
+        self.answered_at = None
+
+
+class LoadRun:
+    def __init__(self, cb):
+        self.cb = cb
+        self.response_times = defaultdict(list)  # command -> seconds from arrival to first response
+        self.unanswered = Counter()
+        self.errors = Counter()
+        self.loop_lag = []
+        self.commit_times = []
+        self.flushes = []  # (seconds, rows)
+        self.instrument()
+
+    def instrument(self):
+        """Time journal commits and SQLite flushes by wrapping the module's functions."""
+        cb = self.cb
+        commit_db, write_changes = cb.commit_db, cb.write_changes
+
+        def timed_commit_db():
+            start = time.perf_counter()
+            durable = commit_db()
+            durable.add_done_callback(lambda _: self.commit_times.append(time.perf_counter() - start))
+            return durable
+
+        def timed_write_changes(conn, changes):
+            start = time.perf_counter()
+            write_changes(conn, changes)
+            self.flushes.append((time.perf_counter() - start, len(changes)))
+
+        cb.commit_db = timed_commit_db
+        cb.write_changes = timed_write_changes
+
+    async def handle(self, command, guild_id, user_id, other_id, created_at):
+        cb = self.cb
+        user, other = FakeMember(user_id), FakeMember(other_id)
+        interactions = [SimulatedInteraction(guild_id, user, created_at)]
+        try:
+            if command == "trade":
+                await invoke(cb.trade, interactions[0], other, "gold", 1, "silver", 1)
+                view = interactions[0].view()
+                if view is not None:
+                    for who in (user, other):
+                        confirm = SimulatedInteraction(guild_id, who, time.perf_counter())
+                        interactions.append(confirm)
+                        await press(view.confirm, confirm)
+            elif command == "balance":
+                await invoke(cb.balance, interactions[0], None)
+            elif command == "gamble":
+                await invoke(cb.gamble, interactions[0], random.choice(CURRENCIES), random.randint(1, 20))
+            elif command == "give":
+                await invoke(cb.give, interactions[0], random.choice(CURRENCIES), other, random.randint(1, 20))
+            elif command == "rob":
+                await invoke(cb.rob, interactions[0], other, None)
+            elif command == "rank":
+                await invoke(cb.rank, interactions[0], random.choice(CURRENCIES), None)
+            else:
+                await invoke(getattr(cb, command), interactions[0])
+        except Exception as e:
+            self.errors[f"{command}: {type(e).__name__}: {e}"] += 1
+        for interaction in interactions:
+            if interaction.answered_at is None:
+                self.unanswered[command] += 1
+            else:
+                self.response_times[command].append(interaction.answered_at - interaction.created_at)
+
+    async def probe_loop_lag(self, stop):
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            self.loop_lag.append(time.perf_counter() - start - LAG_PROBE_INTERVAL)
+
+    async def replay(self, trace):
+        """Start each interaction at its scheduled offset, whether or not earlier ones finished."""
+        stop = asyncio.Event()
+        prober = asyncio.create_task(self.probe_loop_lag(stop))
+        tasks = []
+        start = time.perf_counter()
+        for at, command, guild_id, user_id, other_id in trace:
+            delay = start + at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self.handle(command, guild_id, user_id, other_id, start + at)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await prober
+        return elapsed
+
+
+def pct(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def ms(samples):
+    return f"p50 {pct(samples, 0.5) * 1000:8.2f}  p99 {pct(samples, 0.99) * 1000:8.2f}  max {max(samples or [0]) * 1000:8.2f} ms"
+
+
+def report(run, trace, elapsed, label):
+    all_times = [t for times in run.response_times.values() for t in times]
+    misses = sum(1 for t in all_times if t > DEADLINE) + sum(run.unanswered.values())
+    answered = len(all_times)
+    print(f"\n=== {label}: {len(trace):,} interactions, achieved {len(trace) / elapsed:,.0f}/s over {elapsed:.1f} s ===")
+    print(f"  response time    {ms(all_times)}")
+    print(f"  deadline misses  {misses:,} ({misses / max(answered, 1):.2%}) over {DEADLINE:.0f} s or never answered")
+    print(f"  event loop lag   {ms(run.loop_lag)}")
+    print(f"  journal commit   {ms(run.commit_times)}  ({len(run.commit_times):,} commits)")
+    flush_times = [seconds for seconds, _ in run.flushes]
+    flush_rows = [rows for _, rows in run.flushes]
+    print(f"  SQLite flush     {ms(flush_times)}  ({len(run.flushes):,} flushes, "
+          f"median {pct(flush_rows, 0.5):,} rows)")
+    print(f"  {'command':<12} {'count':>7} {'p50 ms':>9} {'p99 ms':>9}")
+    for command, times in sorted(run.response_times.items(), key=lambda item: -len(item[1])):
+        print(f"  {command:<12} {len(times):>7,} {pct(times, 0.5) * 1000:9.2f} {pct(times, 0.99) * 1000:9.2f}")
+    for error, count in run.errors.most_common(5):
+        print(f"  ❌ {count}x {error}")
+
+
+def run_trace(trace, guilds, users, label):
+    with tempfile.TemporaryDirectory() as workdir:
+        cb = load_bot_module(workdir)
+        populate(cb, guilds, users)
+        cb.load_db()
+        cb.db_writer.start()
+        run = LoadRun(cb)
+        try:
+            elapsed = asyncio.run(run.replay(trace))
+        finally:
+            cb.shutdown_db()
+    report(run, trace, elapsed, label)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, nargs="+", default=[100, 500, 1000], help="interactions per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of traffic per rate")
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--users", type=int, default=500, help="members per guild")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", help="replay this saved trace instead of generating one")
+    parser.add_argument("--save-trace", help="write the generated trace here (JSON lines)")
+    args = parser.parse_args()
+
+    if args.trace:
+        with open(args.trace) as f:
+            trace = [tuple(json.loads(line)) for line in f]
+        run_trace(trace, args.guilds, args.users, f"replay of {args.trace}")
+        return
+
+    for rate in args.rate:
+        trace = generate_trace(rate, args.duration, args.guilds, args.users, args.seed)
+        if args.save_trace:
+            with open(args.save_trace, "w") as f:
+                f.writelines(json.dumps(event) + "\n" for event in trace)
+        run_trace(trace, args.guilds, args.users, f"target {rate:,.0f}/s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
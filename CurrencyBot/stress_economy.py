@@ -0,0 +1,228 @@
+"""
+Stress test: run thousands of interleaved /give, /trade, /gamble, /rob, /buy and /use
+interactions as asyncio tasks against the real command handlers, then check that the
+economy still adds up.
+
+Invariants checked:
+  - no balance, jackpot or inventory count is negative
+  - per currency, balances + jackpot == starting supply + minted - burned (from the ledger)
+  - per account, the ledger's net flow equals the change in its balance
+  - inventory counts equal successful buys minus successful uses
+  - every interaction was answered exactly once
+  - what reached SQLite matches memory
+  - concurrent /rob calls queued behind a held jackpot lock rob at most once per cooldown
+
+Usage: python stress_economy.py [operations] [users] [concurrency]   (default: 5000 50 200)
+"""
+import asyncio
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from harness import FakeInteraction, FakeMember, invoke, load_bot_module, press
+
+GUILD_ID = 1
+RACE_GUILD_ID = 2  # kept apart so the race checks don't disturb the main run's invariants
+CURRENCIES = ("gold", "silver", "bronze")
+START_BALANCE = 1000
+ITEMS = ("energy_drink", "rf_shield")
+
+
+class StressRun:
+    def __init__(self, cb, users, seed):
+        self.cb = cb
+        self.users = [FakeMember(user_id) for user_id in range(100, 100 + users)]
+        self.rng = random.Random(seed)
+        self.ops = Counter()
+        self.rejected = Counter()
+        self.inventory = Counter()  # (user_id, item) -> successful buys - successful uses
+        self.interactions = []
+
+    def interaction(self, user):
+        interaction = FakeInteraction(GUILD_ID, user)
+        self.interactions.append(interaction)
+        return interaction
+
+    def setup(self):
+        cb = self.cb
+        for name in CURRENCIES:
+            cb.add_guild_currency(GUILD_ID, name, "💰")
+            cb.set_jackpot(GUILD_ID, name, 0)
+            for user in self.users:
+                cb.set_user_balance(GUILD_ID, name, user.id, START_BALANCE)
+        cb.set_guild_cooldown(GUILD_ID, "rob", 0)
+        cb.save_db()
+
+    async def run_op(self):
+        cb, rng = self.cb, self.rng
+        kind = rng.choices(("give", "trade", "gamble", "rob", "buy", "use"), (25, 15, 25, 15, 10, 10))[0]
+        user, other = rng.sample(self.users, 2)
+        currency = rng.choice(CURRENCIES)
+        amount = rng.randint(1, START_BALANCE // 2)
+        self.ops[kind] += 1
+
+        if kind == "give":
+            interaction = self.interaction(user)
+            await invoke(cb.give, interaction, currency, other, amount)
+        elif kind == "trade":
+            interaction = self.interaction(user)
+            await invoke(cb.trade, interaction, other, currency, amount, rng.choice(CURRENCIES), rng.randint(1, amount))
+            view = interaction.view()
+            if view is None:
+                self.rejected[kind] += 1
+                return
+            # Both sides confirm at once; the author double-clicks
+            await asyncio.gather(*(press(view.confirm, self.interaction(who)) for who in (user, other, user)))
+            return
+        elif kind == "gamble":
+            interaction = self.interaction(user)
+            await invoke(cb.gamble, interaction, currency, amount)
+        elif kind == "rob":
+            interaction = self.interaction(user)
+            await invoke(cb.rob, interaction, other if rng.random() < 0.5 else None, None)
+        elif kind == "buy":
+            item = rng.choice(ITEMS)
+            interaction = self.interaction(user)
+            await invoke(cb.buy, interaction, item, currency)
+            if interaction.text().startswith("✅"):
+                self.inventory[(user.id, item)] += 1
+        else:
+            item = rng.choice(ITEMS)
+            interaction = self.interaction(user)
+            await invoke(cb.use, interaction, item)
+            if not interaction.text().startswith("❌") and "already" not in interaction.text():
+                self.inventory[(user.id, item)] -= 1
+
+        if interaction.text().startswith("❌"):
+            self.rejected[kind] += 1
+
+    async def run(self, operations, concurrency):
+        gate = asyncio.Semaphore(concurrency)
+
+        async def task():
+            async with gate:
+                await self.run_op()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(task() for _ in range(operations)))
+        return time.perf_counter() - start
+
+    def check(self):
+        """Return a list of invariant violations."""
+        cb = self.cb
+        violations = []
+        guild_currencies = cb.currencies_data[GUILD_ID]
+        pots = cb.jackpots.get(GUILD_ID, {})
+
+        for name in CURRENCIES:
+            for user_id, amount in guild_currencies[name]["balances"].items():
+                if amount < 0:
+                    violations.append(f"negative balance: user {user_id} has {amount} {name}")
+            if pots.get(name, 0) < 0:
+                violations.append(f"negative jackpot: {pots[name]} {name}")
+
+        cb.save_db()
+        cb.db_writer.flush()
+        conn = sqlite3.connect(cb.DB_PATH)
+        try:
+            flows = Counter()  # (account, currency) -> net inflow; account None is the bot
+            for from_user, to_user, currency, amount in conn.execute(
+                    "SELECT from_user, to_user, currency, amount FROM ledger WHERE guild_id = ?", (GUILD_ID,)):
+                flows[(from_user, currency)] -= amount
+                flows[(to_user, currency)] += amount
+            stored = {(user_id, currency): amount for user_id, currency, amount in conn.execute(
+                "SELECT user_id, currency, amount FROM balances WHERE guild_id = ?", (GUILD_ID,))}
+            stored_pots = dict(conn.execute("SELECT currency, amount FROM jackpots WHERE guild_id = ?", (GUILD_ID,)))
+        finally:
+            conn.close()
+
+        for name in CURRENCIES:
+            balances = guild_currencies[name]["balances"]
+            supply = sum(balances.values()) + pots.get(name, 0)
+            expected = START_BALANCE * len(self.users) - flows[(None, name)]
+            if supply != expected:
+                violations.append(f"supply of {name} is {supply}, ledger says {expected}")
+            for user in self.users:
+                change = balances.get(user.id, 0) - START_BALANCE
+                if change != flows[(user.id, name)]:
+                    violations.append(f"user {user.id} {name} changed by {change}, ledger says {flows[(user.id, name)]}")
+                if stored.get((user.id, name)) != balances.get(user.id):
+                    violations.append(f"user {user.id} {name} is {balances.get(user.id)} in memory, "
+                                      f"{stored.get((user.id, name))} in SQLite")
+            if pots.get(name, 0) != flows[(cb.JACKPOT_ACCOUNT, name)]:
+                violations.append(f"jackpot {name} is {pots.get(name, 0)}, ledger says {flows[(cb.JACKPOT_ACCOUNT, name)]}")
+            if stored_pots.get(name) != pots.get(name):
+                violations.append(f"jackpot {name} is {pots.get(name)} in memory, {stored_pots.get(name)} in SQLite")
+
+        guild_inventories = cb.inventories.get(GUILD_ID, {})
+        for user in self.users:
+            for item in ITEMS:
+                qty = guild_inventories.get(user.id, {}).get(item, 0)
+                if qty < 0 or qty != self.inventory[(user.id, item)]:
+                    violations.append(f"user {user.id} owns {qty} {item}, expected {self.inventory[(user.id, item)]}")
+
+        unanswered = sum(1 for interaction in self.interactions if not interaction.response.done)
+        if unanswered:
+            violations.append(f"{unanswered} interactions were never answered")
+        return violations
+
+
+async def rob_cooldown_race(cb, robs=5):
+    """
+    Queue several /rob calls from one user behind a jackpot lock held as a /gamble would,
+    then let them through. With an hour's cooldown only the first may rob; returns violations.
+    """
+    robber, victim = FakeMember(1), FakeMember(2)
+    cb.add_guild_currency(RACE_GUILD_ID, "gold", "💰")
+    for user in (robber, victim):
+        cb.set_user_balance(RACE_GUILD_ID, "gold", user.id, START_BALANCE)
+    cb.set_guild_cooldown(RACE_GUILD_ID, "rob", 3600)
+
+    interactions = [FakeInteraction(RACE_GUILD_ID, robber) for _ in range(robs)]
+    async with cb.account_lock(RACE_GUILD_ID, cb.JACKPOT_ACCOUNT):
+        tasks = [asyncio.create_task(invoke(cb.rob, interaction, victim, None)) for interaction in interactions]
+        # Let every call pass the up-front cooldown check and wait on the lock
+        for _ in range(5):
+            await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+
+    robbed = sum(1 for interaction in interactions
+                 if interaction.replies and getattr(interaction.replies[-1][1].get("embed"), "title", None) == "💸 Robbery Attempt")
+    if robbed != 1:
+        return [f"{robbed} of {robs} concurrent /rob calls robbed within one cooldown"]
+    return []
+
+
+def main(operations, users, concurrency):
+    with tempfile.TemporaryDirectory() as workdir:
+        cb = load_bot_module(workdir)
+        cb.load_db()
+        cb.db_writer.start()
+        run = StressRun(cb, users, seed=0)
+        run.setup()
+        try:
+            elapsed = asyncio.run(run.run(operations, concurrency))
+            violations = run.check()
+            violations += asyncio.run(rob_cooldown_race(cb))
+        finally:
+            cb.shutdown_db()
+
+    print(f"{operations:,} operations, {users} users, {concurrency} concurrent: "
+          f"{elapsed:.2f} s, {operations / elapsed:,.0f} ops/sec")
+    for kind, count in sorted(run.ops.items()):
+        print(f"  {kind:<7} {count:>7,}  rejected {run.rejected[kind]:>7,}")
+    if violations:
+        print(f"❌ {len(violations)} invariant violations:")
+        for violation in violations[:50]:
+            print(f"  {violation}")
+        return 1
+    print("✅ All invariants held")
+    return 0
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    sys.exit(main(*(args + [5000, 50, 200][len(args):])))